@@ -1,18 +1,19 @@
 import os
-import re
-import json
-import requests
+import signal
+import threading
 import time
-import base64
-from typing import Tuple
-from PIL import Image
-from io import BytesIO
 
 import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from plugins import *
+from plugins import Event, EventAction, EventContext, Plugin
+from .admission import DrainingError
+from .compiled_config import ConfigError, config_property
+from .deadline import Deadline, DeadlineExceeded, JobCancelled
+from .engine import QwenImageEngine, load_config_file
+from .structured_log import request_context, slog
+from .usage_meter import BudgetExceededError
 
 @plugins.register(
     name="QwenImage",
@@ -22,125 +23,109 @@ from plugins import *
     version="1.0.0",
     author="Assistant",
 )
-class QwenImage(Plugin):
+class QwenImage(Plugin, QwenImageEngine):
+    # 各命令的前缀（绘图、图像编辑、智能扩写控制、快速预览开关、账号切换、任务统计）
+    drawing_prefixes = property(lambda self: self.config.commands["draw"])
+    edit_prefixes = property(lambda self: self.config.commands["edit"])
+    control_prefixes = property(lambda self: self.config.commands["control"])
+    preview_prefixes = property(lambda self: self.config.commands["preview"])
+    account_prefixes = property(lambda self: self.config.commands["account"])
+    stats_prefixes = property(lambda self: self.config.commands["stats"])
+    admin_prefixes = property(lambda self: self.config.commands["admin"])
+    command_trie = config_property("command_trie")
+
     def __init__(self):
         super().__init__()
         try:
             conf = super().load_config()
-            if not conf:
-                raise Exception("配置未找到。")
-
-            # 读取Qwen Image配置
-            qwen_config = conf.get("qwen_image", {})
-            if not qwen_config:
-                raise Exception("在配置中未找到qwen_image配置。")
-
-            self.base_url = qwen_config.get("base_url", "https://dashscope.aliyuncs.com/api/v1/services/aigc/text2image/image-synthesis")
-            self.models = qwen_config.get("model", ["qwen-image", "wan2.2-t2i-flash", "wan2.2-t2i-plus"])
-            self.default_model = "qwen-image"  # 默认使用qwen-image模型
-            
-            # 读取Qwen Image Edit配置  
-            qwen_edit_config = conf.get("qwen_image_edit", {})
-            self.edit_base_url = qwen_edit_config.get("base_url", "https://dashscope.aliyuncs.com/api/v1/services/aigc/multimodal-generation/generation")
-            self.edit_models = qwen_edit_config.get("model", ["qwen-image-edit"])
-            self.default_edit_model = "qwen-image-edit"  # 默认使用qwen-image-edit模型
-            
-            # API密钥配置（文生图和图生图共用）
-            self.api_key_1 = conf.get("api_key_1", "")
-            self.api_key_2 = conf.get("api_key_2", "")
-            self.current_api_key = self.api_key_1  # 默认使用第一个API密钥
-            self.current_account = 1  # 当前使用的账号编号
-            
-            # 绘图命令前缀
-            self.drawing_prefixes = conf.get("image_command", ["Q画图", "Q生成"])
-            
-            # 图像编辑命令前缀
-            self.edit_prefixes = conf.get("image_edit_command", ["Q改图", "Q编辑"])
-            
-            # 控制命令前缀
-            self.control_prefixes = conf.get("control_command", ["Q开启智能扩写", "Q禁用智能扩写"])
-            
-            # 账号切换命令前缀
-            self.account_prefixes = conf.get("account_command", ["Q切换账号 1", "Q切换账号 2"])
-            
-            # 图片比例配置
-            self.ratios = qwen_config.get("ratios", {
-                "1:1": {"width": 1328, "height": 1328},
-                "3:4": {"width": 1140, "height": 1472},
-                "4:3": {"width": 1472, "height": 1140},
-                "16:9": {"width": 1664, "height": 928},
-                "9:16": {"width": 928, "height": 1664}
-            })
-            self.default_ratio = qwen_config.get("default_ratio", "1:1")
-            
-            # 默认负面提示词配置
-            self.default_negative_prompt = qwen_config.get("default_negative_prompt", "色调艳丽，过曝，静态，细节模糊不清，风格，画面，整体发灰，最差质量，低质量， JPEG压缩残留，丑陋的，残缺的，多余的手指，杂乱的背景，三条腿")
-            
-            # 用户状态管理（用于存储每个用户的智能扩写设置）
-            self.user_prompt_extend_settings = {}  # 用户ID -> 智能扩写设置
-            self.global_prompt_extend = True  # 全局默认智能扩写设置
+            # 生成引擎：配置、参数解析、文生图、图生图（与批量CLI共用）
+            QwenImageEngine.__init__(self, conf)
+            
+            # 命令处理函数，按优先级顺序分发；命令前缀树在编译配置时构建
+            self.command_handlers = [
+                ("draw", self.handle_drawing_command),
+                ("edit", self.handle_edit_command),
+                ("control", self.handle_control_command),
+                ("preview", self.handle_preview_command),
+                ("account", self.handle_account_command),
+                ("stats", self.handle_stats_command),
+                ("admin", self.handle_admin_command),
+            ]
             
             # 图像编辑状态管理（用于存储等待上传图片的用户）
             self.pending_edit_users = {}  # 用户ID -> 编辑指令
+            
+            # 渐进模式下已交付预览、仍在等待最终图片的任务，同一会话发起新命令时取消
+            self.progressive_jobs = {}  # 用户ID -> 最终任务的Deadline
 
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+            
+            # 部署重启时先排空：收到SIGTERM后停止受理新任务，等待进行中的任务完成再退出
+            if self.config.drain.get("on_sigterm", False):
+                self._install_sigterm_drain()
 
-            logger.info(f"[QwenImage] 初始化成功，文生图模型: {self.models}，图生图模型: {self.edit_models}")
+            logger.info(f"[QwenImage] 初始化成功，文生图模型: {list(self.models)}，图生图模型: {list(self.edit_models)}")
         except Exception as e:
             logger.error(f"[QwenImage] 初始化失败，错误：{e}")
             raise e
 
     def on_handle_context(self, e_context: EventContext):
-        context_type = e_context["context"].type
-        session_id = self.get_session_id(e_context["context"])
-        content = e_context["context"].content
-        
-        # 获取消息对象用于检查引用图片
-        msg_from_context = e_context["context"]
-        actual_msg_object = msg_from_context.kwargs.get('msg') if hasattr(msg_from_context, 'kwargs') else None
-
-        # 检查是否是引用图片的Q改图命令（最高优先级）
-        if actual_msg_object and \
-           hasattr(actual_msg_object, 'is_processed_image_quote') and \
-           actual_msg_object.is_processed_image_quote and \
-           hasattr(actual_msg_object, 'referenced_image_path') and \
-           actual_msg_object.referenced_image_path and \
-           context_type == ContextType.TEXT and \
-           content and content.startswith(tuple(self.edit_prefixes)):
-            
-            logger.info(f"[QwenImage] 检测到引用图片的Q改图命令: {content}")
-            self.handle_referenced_image_edit(e_context, content, actual_msg_object.referenced_image_path)
-            return
+        context = e_context["context"]
+        context_type = context.type
         
         # 处理图像输入（用于图像编辑）
         if context_type == ContextType.IMAGE:
-            if session_id in self.pending_edit_users:
-                self.handle_image_upload(e_context)
+            if self.pending_edit_users and self.get_session_id(context) in self.pending_edit_users:
+                with request_context():
+                    self._admit(e_context, self.handle_image_upload)
             return
         
         # 处理文本输入
         if context_type != ContextType.TEXT:
             return
         
-        # 检查是否是绘图命令
-        if content.startswith(tuple(self.drawing_prefixes)):
-            self.handle_drawing_command(e_context)
-        # 检查是否是图像编辑命令
-        elif content.startswith(tuple(self.edit_prefixes)):
-            self.handle_edit_command(e_context)
-        # 检查是否是控制命令
-        elif content.startswith(tuple(self.control_prefixes)):
-            self.handle_control_command(e_context)
-        # 检查是否是账号切换命令
-        elif content.startswith(tuple(self.account_prefixes)):
-            self.handle_account_command(e_context)
-        else:
+        # 前缀树一次遍历匹配所有命令前缀，不是命令的消息在首字符处即可返回
+        content = context.content
+        matched = self.command_trie.match(content) if content else None
+        if not matched:
             return
+        
+        # 同一会话发起新的绘图/改图命令时，取消其仍在等待的渐进模式最终任务
+        if self.progressive_jobs and ("draw" in matched or "edit" in matched):
+            self._supersede_progressive_job(self.get_session_id(context))
+        
+        # 检查是否是引用图片的Q改图命令（最高优先级）
+        if "edit" in matched:
+            # 获取消息对象用于检查引用图片
+            actual_msg_object = context.kwargs.get('msg') if hasattr(context, 'kwargs') else None
+            if actual_msg_object and \
+               hasattr(actual_msg_object, 'is_processed_image_quote') and \
+               actual_msg_object.is_processed_image_quote and \
+               hasattr(actual_msg_object, 'referenced_image_path') and \
+               actual_msg_object.referenced_image_path:
+                
+                with request_context():
+                    slog.info("检测到引用图片的Q改图命令", content=content)
+                    self._admit(e_context, self.handle_referenced_image_edit, content, actual_msg_object.referenced_image_path)
+                return
+        
+        # 按优先级分发：绘图、图像编辑、控制、快速预览、账号切换、任务统计、管理
+        # 每条命令分配一个关联ID，串联提交、轮询和交付的日志；绘图和图像编辑需经过受理闸门
+        for command, handler in self.command_handlers:
+            if command in matched:
+                with request_context():
+                    if command in ("draw", "edit"):
+                        self._admit(e_context, handler)
+                    else:
+                        handler(e_context)
+                return
 
     def handle_drawing_command(self, e_context: EventContext):
         """处理绘图命令"""
         content = e_context["context"].content
-        logger.debug(f"[QwenImage] 收到绘图消息: {content}")
+        slog.debug("收到绘图消息", content=content)
+        # 截止时间从受理时开始计算
+        deadline = Deadline(self.job_deadline)
 
         try:
             # 移除前缀
@@ -153,36 +138,79 @@ class QwenImage(Plugin):
 
             # 解析用户输入
             prompt_text, image_size, model, prompt_extend, negative_prompt = self.parse_user_input(content, e_context["context"])
-            logger.debug(f"[QwenImage] 解析后的参数: 提示词={prompt_text}, 尺寸={image_size}, 模型={model}")
+            slog.debug("解析后的参数", prompt=prompt_text, size=image_size, model=model)
 
             if not prompt_text:
                 reply = Reply(ReplyType.TEXT, "请输入需要生成的图片描述")
                 e_context["reply"] = reply
             else:
+                # 会话今日额度不足时直接拒绝，不发送进度提醒
+                session_id = self.get_session_id(e_context["context"])
+                self.usage.check_session_budget(session_id, self.usage.estimate(model))
+
+                # 渐进模式只用于默认模型：快速模型先出预览，默认模型随后交付最终图片
+                progressive = (self.get_user_preview_setting(session_id) and model == self.default_model
+                               and self.prompt_parser.flash_model != model)
+
                 # 发送进度提醒消息
                 ratio_display = self.extract_ratio_from_prompt(e_context["context"].content)
-                progress_message = f"🌁正在使用 {model} 模型以 {ratio_display} 比例生成图片，请稍候..."
+                if progressive:
+                    progress_message = f"🌁正在使用 {self.prompt_parser.flash_model} 模型生成预览、{model} 模型生成最终图片（{ratio_display}），请稍候..."
+                else:
+                    progress_message = f"🌁正在使用 {model} 模型以 {ratio_display} 比例生成图片，请稍候..."
                 
                 # 先发送进度提醒
                 wait_reply = Reply(ReplyType.TEXT, progress_message)
                 e_context["channel"].send(wait_reply, e_context["context"])
                 
                 # 生成图片
-                image_url = self.generate_image(prompt_text, image_size, model, prompt_extend, negative_prompt)
-                logger.debug(f"[QwenImage] 生成的图片URL: {image_url}")
+                preview_sent = False
+                if progressive:
+                    def send_preview(preview_url):
+                        nonlocal preview_sent
+                        e_context["channel"].send(Reply(ReplyType.IMAGE_URL, preview_url), e_context["context"])
+                        preview_sent = True
+                        self._record_first_image(deadline)
+                        slog.info("快速预览已交付", url=preview_url, elapsed=f"{deadline.elapsed():.1f}s")
+
+                    self.progressive_jobs[session_id] = deadline
+                    try:
+                        image_url = self.generate_image_progressive(prompt_text, image_size, model, prompt_extend, negative_prompt,
+                                                                    send_preview, deadline=deadline, session_id=session_id)
+                    finally:
+                        if self.progressive_jobs.get(session_id) is deadline:
+                            del self.progressive_jobs[session_id]
+                else:
+                    image_url = self.generate_image(prompt_text, image_size, model, prompt_extend, negative_prompt, deadline=deadline, session_id=session_id)
 
                 if image_url:
+                    if deadline.expired():
+                        slog.warning("图片在截止时间之后才完成，仍然交付", elapsed=f"{deadline.elapsed():.1f}s")
                     # 发送图片
                     e_context["channel"].send(Reply(ReplyType.IMAGE_URL, image_url), e_context["context"])
-                    logger.info(f"[QwenImage] 图片生成成功，URL: {image_url}")
+                    if not preview_sent:
+                        self._record_first_image(deadline)
+                    slog.info("图片生成成功，已交付", url=image_url, elapsed=f"{deadline.elapsed():.1f}s")
                     # 不设置reply，因为已经通过channel发送了回复
                 else:
-                    logger.error("[QwenImage] 生成图片失败")
+                    slog.error("生成图片失败")
                     reply = Reply(ReplyType.ERROR, "生成图片失败。")
                     e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
+        except JobCancelled as e:
+            # 用户已发起新命令，预览图已交付，不再打扰用户
+            slog.info("最终图片任务已被新的命令取代", error=e, cancelled=e.cancelled)
+            e_context.action = EventAction.BREAK_PASS
+        except DeadlineExceeded as e:
+            slog.warning("绘图任务超时", error=e, cancelled=e.cancelled)
+            e_context["reply"] = Reply(ReplyType.TEXT, self._deadline_message(e))
+            e_context.action = EventAction.BREAK_PASS
+        except BudgetExceededError as e:
+            slog.warning("预算不足，拒绝绘图请求", error=e)
+            e_context["reply"] = Reply(ReplyType.TEXT, f"💰 {e}")
+            e_context.action = EventAction.BREAK_PASS
         except Exception as e:
-            logger.error(f"[QwenImage] 发生错误: {e}")
+            slog.error("发生错误", error=e)
             reply = Reply(ReplyType.ERROR, f"发生错误: {str(e)}")
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
@@ -262,6 +290,23 @@ class QwenImage(Plugin):
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
 
+    def handle_preview_command(self, e_context: EventContext):
+        """处理快速预览开关命令"""
+        content = e_context["context"].content
+        session_id = self.get_session_id(e_context["context"])
+        logger.debug(f"[QwenImage] 收到快速预览消息: {content}")
+
+        if content.startswith(self.preview_prefixes[0]):
+            self.user_preview_settings[session_id] = True
+            reply = Reply(ReplyType.TEXT, f"✅ 已开启快速预览：使用 {self.default_model} 模型时先发送 {self.prompt_parser.flash_model} 模型的预览图，再发送最终图片")
+            logger.info(f"[QwenImage] 用户 {session_id} 开启快速预览")
+        else:
+            self.user_preview_settings[session_id] = False
+            reply = Reply(ReplyType.TEXT, "❌ 已关闭快速预览")
+            logger.info(f"[QwenImage] 用户 {session_id} 关闭快速预览")
+        e_context["reply"] = reply
+        e_context.action = EventAction.BREAK_PASS
+
     def handle_account_command(self, e_context: EventContext):
         """处理账号切换命令"""
         content = e_context["context"].content
@@ -296,6 +341,48 @@ class QwenImage(Plugin):
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
 
+    def handle_stats_command(self, e_context: EventContext):
+        """处理任务统计命令"""
+        with self._stats_lock:
+            stats = dict(self.job_stats)
+        avg_render = stats["render_seconds"] / stats["succeeded"] if stats["succeeded"] else 0.0
+        avg_first_image = stats["first_image_seconds"] / stats["first_images"] if stats["first_images"] else 0.0
+        lines = [
+            "📊 QwenImage 任务统计",
+            f"已提交任务: {stats['submitted']}，成功: {stats['succeeded']}，平均耗时: {avg_render:.1f}秒",
+            f"超时任务: {stats['deadline_exceeded']}（截止时间 {self.job_deadline} 秒）",
+            f"已取消排队任务: {stats['cancelled']}，取消失败: {stats['cancel_failed']}，超时时已在运行: {stats['expired_running']}",
+            f"避免的算力浪费: 约 {stats['cancelled']} 张图片 / {stats['cancelled'] * avg_render:.0f} 秒",
+            f"平均首图时间: {avg_first_image:.1f}秒，快速预览: {stats['previews']}（已停止: {stats['previews_dropped']}），被新命令取代: {stats['superseded']}",
+            f"受理状态: {'排空中' if self.admission.draining else '正常'}，进行中的任务: {self.admission.in_flight}",
+            f"对冲提交: {stats['hedged']}，对冲胜出: {stats['hedge_won']}，取消重复任务: {stats['hedge_cancelled']}，熔断拒绝: {stats['circuit_rejected']}",
+        ]
+        state_names = {"closed": "正常", "open": "熔断", "half_open": "探测中"}
+        for account, snapshot in sorted(self.key_breakers.snapshot().items()):
+            lines.append(f"账号 {account}: {state_names[snapshot['state']]}，近期请求 {snapshot['calls']}，错误率 {snapshot['error_rate']:.0%}")
+        for url, snapshot in self.endpoint_breakers.snapshot().items():
+            lines.append(f"接口 {url.split('/services/')[-1]}: {state_names[snapshot['state']]}，近期请求 {snapshot['calls']}，错误率 {snapshot['error_rate']:.0%}")
+
+        # 今日用量和预算（费用按配置的单价估算）
+        usage = self.usage.snapshot()
+        total_images = sum(entry[0] for entry in usage["key"].values())
+        total_cost = sum(entry[1] for entry in usage["key"].values())
+        lines.append(f"今日用量: {total_images} 张，约 ¥{total_cost:.2f}")
+        for account in sorted(self.api_keys):
+            images, cost = usage["key"].get(str(account), [0, 0.0])
+            remaining = self.usage.remaining_key_budget(account)
+            budget_text = "不限" if remaining is None else f"¥{max(remaining, 0):.2f}"
+            lines.append(f"账号 {account} 今日: {images} 张 / ¥{cost:.2f}，预算剩余 {budget_text}")
+        for model, (images, cost) in sorted(usage["model"].items()):
+            lines.append(f"模型 {model} 今日: {images} 张 / ¥{cost:.2f}")
+        session_id = self.get_session_id(e_context["context"])
+        images, cost = usage["session"].get(session_id, [0, 0.0])
+        remaining = self.usage.remaining_session_budget(session_id)
+        budget_text = "不限" if remaining is None else f"¥{max(remaining, 0):.2f}"
+        lines.append(f"本会话今日: {images} 张 / ¥{cost:.2f}，额度剩余 {budget_text}")
+        e_context["reply"] = Reply(ReplyType.TEXT, "\n".join(lines))
+        e_context.action = EventAction.BREAK_PASS
+
     def handle_referenced_image_edit(self, e_context: EventContext, content: str, referenced_image_path: str):
         """处理引用图片的Q改图命令
         Args:
@@ -305,8 +392,9 @@ class QwenImage(Plugin):
         """
         context = e_context['context']
         session_id = self.get_session_id(context)
+        deadline = Deadline(self.job_deadline)
         
-        logger.info(f"[QwenImage] 处理引用图片改图命令: {content}, 图片路径: {referenced_image_path}")
+        slog.info("处理引用图片改图命令", content=content, image=referenced_image_path)
         
         try:
             # 移除前缀，获取编辑指令
@@ -326,7 +414,7 @@ class QwenImage(Plugin):
             progress_reply = Reply(ReplyType.TEXT, progress_message)
             e_context["channel"].send(progress_reply, context)
             
-            logger.info(f"[QwenImage] 开始为用户 {session_id} 编辑引用图片，指令: {edit_prompt}")
+            slog.info("开始编辑引用图片", session=session_id, prompt=edit_prompt)
             
             # 获取引用图片数据
             image_data = self._get_referenced_image_data(referenced_image_path)
@@ -337,20 +425,28 @@ class QwenImage(Plugin):
                 return
             
             # 调用图像编辑API，传入图片数据而不是路径
-            edited_image_url = self.edit_image(image_data, edit_prompt)
+            edited_image_url = self.edit_image(image_data, edit_prompt, deadline=deadline, session_id=session_id)
             
             if edited_image_url:
                 # 发送编辑后的图片
                 e_context["channel"].send(Reply(ReplyType.IMAGE_URL, edited_image_url), context)
-                logger.info(f"[QwenImage] 引用图片编辑成功，URL: {edited_image_url}")
+                slog.info("引用图片编辑成功，已交付", url=edited_image_url, elapsed=f"{deadline.elapsed():.1f}s")
             else:
-                logger.error("[QwenImage] 引用图片编辑失败")
+                slog.error("引用图片编辑失败")
                 reply = Reply(ReplyType.ERROR, "引用图片编辑失败。")
                 e_context["channel"].send(reply, context)
                 
+            e_context.action = EventAction.BREAK_PASS
+        except DeadlineExceeded as e:
+            slog.warning("引用图片编辑超时", error=e)
+            e_context["channel"].send(Reply(ReplyType.TEXT, self._deadline_message(e)), context)
+            e_context.action = EventAction.BREAK_PASS
+        except BudgetExceededError as e:
+            slog.warning("预算不足，拒绝改图请求", error=e)
+            e_context["channel"].send(Reply(ReplyType.TEXT, f"💰 {e}"), context)
             e_context.action = EventAction.BREAK_PASS
         except Exception as e:
-            logger.error(f"[QwenImage] 引用图片编辑处理错误: {e}")
+            slog.error("引用图片编辑处理错误", error=e)
             reply = Reply(ReplyType.ERROR, f"引用图片编辑处理错误: {str(e)}")
             e_context["channel"].send(reply, context)
             e_context.action = EventAction.BREAK_PASS
@@ -358,7 +454,8 @@ class QwenImage(Plugin):
     def handle_image_upload(self, e_context: EventContext):
         """处理用户上传的图像，进行图像编辑"""
         session_id = self.get_session_id(e_context["context"])
-        logger.debug(f"[QwenImage] 用户 {session_id} 上传了图片")
+        slog.debug("用户上传了图片", session=session_id)
+        deadline = Deadline(self.job_deadline)
 
         try:
             if session_id not in self.pending_edit_users:
@@ -377,400 +474,152 @@ class QwenImage(Plugin):
             wait_reply = Reply(ReplyType.TEXT, progress_message)
             e_context["channel"].send(wait_reply, e_context["context"])
             
-            logger.info(f"[QwenImage] 开始为用户 {session_id} 编辑图片，指令: {edit_prompt}")
+            slog.info("开始编辑图片", session=session_id, prompt=edit_prompt)
             
             # 调用图像编辑API
-            edited_image_url = self.edit_image(e_context["context"].content, edit_prompt)
+            edited_image_url = self.edit_image(e_context["context"].content, edit_prompt, deadline=deadline, session_id=session_id)
             
             if edited_image_url:
                 # 发送编辑后的图片
                 e_context["channel"].send(Reply(ReplyType.IMAGE_URL, edited_image_url), e_context["context"])
-                logger.info(f"[QwenImage] 图片编辑成功，URL: {edited_image_url}")
+                slog.info("图片编辑成功，已交付", url=edited_image_url, elapsed=f"{deadline.elapsed():.1f}s")
             else:
-                logger.error("[QwenImage] 图片编辑失败")
+                slog.error("图片编辑失败")
                 reply = Reply(ReplyType.ERROR, "图片编辑失败。")
                 e_context["reply"] = reply
                 
+            e_context.action = EventAction.BREAK_PASS
+        except DeadlineExceeded as e:
+            slog.warning("图片编辑超时", error=e)
+            e_context["reply"] = Reply(ReplyType.TEXT, self._deadline_message(e))
+            e_context.action = EventAction.BREAK_PASS
+        except BudgetExceededError as e:
+            slog.warning("预算不足，拒绝改图请求", error=e)
+            e_context["reply"] = Reply(ReplyType.TEXT, f"💰 {e}")
             e_context.action = EventAction.BREAK_PASS
         except Exception as e:
-            logger.error(f"[QwenImage] 图像上传处理错误: {e}")
+            slog.error("图像上传处理错误", error=e)
             reply = Reply(ReplyType.ERROR, f"图像上传处理错误: {str(e)}")
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
 
-    def get_session_id(self, context):
-        """获取会话ID，兼容不同的Context对象结构"""
-        try:
-            # 尝试从字典方式获取session_id
-            if hasattr(context, '__getitem__'):
-                return context.get("session_id", "default_user")
-            # 尝试从属性方式获取session_id
-            elif hasattr(context, 'session_id'):
-                return context.session_id
-            # 尝试从from_user_id获取
-            elif hasattr(context, '__getitem__') and context.get("from_user_id"):
-                return context.get("from_user_id")
-            else:
-                return "default_user"
-        except Exception as e:
-            logger.warning(f"[QwenImage] 获取session_id失败: {e}，使用默认值")
-            return "default_user"
-
-    def parse_user_input(self, content: str, context) -> Tuple[str, str, str, bool, str]:
-        """解析用户输入，提取提示词、图片尺寸、模型、智能改写设置和负面提示词"""
-        # 提取图片尺寸参数
-        image_size = self.extract_image_size(content)
-        
-        # 提取模型参数
-        model = self.extract_model(content)
-        
-        # 获取用户的智能改写设置
+    def handle_admin_command(self, e_context: EventContext):
+        """处理管理命令：重新加载配置、暂停服务（排空）、恢复服务，仅限admin_users中的会话"""
+        context = e_context["context"]
+        content = context.content
         session_id = self.get_session_id(context)
-        prompt_extend = self.get_user_prompt_extend_setting(session_id)
-        
-        # 提取负面提示词
-        negative_prompt = self.extract_negative_prompt(content)
-        
-        # 清理提示词，移除所有参数
-        clean_prompt = self.clean_prompt_string(content)
-        
-        logger.debug(f"[QwenImage] 解析用户输入: 尺寸={image_size}, 模型={model}, 智能改写={prompt_extend}, 负面提示词={negative_prompt}, 清理后的提示词={clean_prompt}")
-        return clean_prompt, image_size, model, prompt_extend, negative_prompt
+        e_context.action = EventAction.BREAK_PASS
+        if session_id not in self.config.admin_users:
+            slog.warning("非管理员会话尝试执行管理命令", session=session_id, content=content)
+            e_context["reply"] = Reply(ReplyType.TEXT, "❌ 没有权限执行管理命令")
+            return
 
-    def get_user_prompt_extend_setting(self, session_id: str) -> bool:
-        """获取用户的智能改写设置"""
-        if session_id in self.user_prompt_extend_settings:
-            return self.user_prompt_extend_settings[session_id]
-        else:
-            return self.global_prompt_extend  # 返回全局默认设置
-
-    def extract_image_size(self, prompt: str) -> str:
-        """提取图片尺寸参数"""
-        match = re.search(r'--ar (\d+:\d+)', prompt)
-        if match:
-            ratio = match.group(1).strip()
-            if ratio in self.ratios:
-                width = self.ratios[ratio]["width"]
-                height = self.ratios[ratio]["height"]
-                size = f"{width}x{height}"
+        reload_prefix, drain_prefix, resume_prefix = self.admin_prefixes
+        if content.startswith(reload_prefix):
+            try:
+                config = self.reload()
+                reply = f"✅ 配置已重新加载，文生图模型: {', '.join(config.models)}，已配置账号: {len(config.api_keys)} 个"
+            except ConfigError as e:
+                slog.error("配置不合法，继续使用原配置", error=e)
+                reply = f"❌ 配置不合法，继续使用原配置: {e}"
+            except Exception as e:
+                # 配置文件不存在或不是合法的JSON
+                slog.error("读取配置失败，继续使用原配置", error=e)
+                reply = f"❌ 读取配置失败，继续使用原配置: {e}"
+        elif content.startswith(drain_prefix):
+            grace_period = self.config.drain.get("grace_period", 60)
+            e_context["channel"].send(Reply(ReplyType.TEXT, f"⏸ 已暂停受理新任务，等待 {self.admission.in_flight} 个进行中的任务完成（最多 {grace_period} 秒）..."), context)
+            remaining = self.drain(grace_period)
+            if remaining:
+                reply = f"⚠️ 宽限期已到，仍有 {remaining} 个任务未完成"
             else:
-                size = f"{self.ratios[self.default_ratio]['width']}x{self.ratios[self.default_ratio]['height']}"
-        else:
-            # 使用默认尺寸
-            size = f"{self.ratios[self.default_ratio]['width']}x{self.ratios[self.default_ratio]['height']}"
-        
-        logger.debug(f"[QwenImage] 提取的图片尺寸: {size}")
-        return size
-
-    def extract_model(self, prompt: str) -> str:
-        """提取模型参数"""
-        # 检查是否指定了flash模型
-        if "--flash" in prompt:
-            # 查找flash模型
-            for model in self.models:
-                if "flash" in model.lower():
-                    logger.debug(f"[QwenImage] 检测到--flash参数，使用模型: {model}")
-                    return model
-        
-        # 检查是否指定了plus模型
-        elif "--plus" in prompt:
-            # 查找plus模型
-            for model in self.models:
-                if "plus" in model.lower():
-                    logger.debug(f"[QwenImage] 检测到--plus参数，使用模型: {model}")
-                    return model
-        
-        # 默认使用qwen-image模型
-        logger.debug(f"[QwenImage] 使用默认模型: {self.default_model}")
-        return self.default_model
-
-    def clean_prompt_string(self, prompt: str) -> str:
-        """清理提示词，移除所有参数"""
-        # 移除尺寸参数
-        clean_prompt = re.sub(r'--ar \d+:\d+', '', prompt)
-        # 移除模型参数
-        clean_prompt = clean_prompt.replace('--plus', '')
-        clean_prompt = clean_prompt.replace('--flash', '')
-        # 移除负面提示词参数
-        clean_prompt = re.sub(r'--负面提示：[^，。！？]*', '', clean_prompt)
-        # 清理多余空格
-        clean_prompt = re.sub(r'\s+', ' ', clean_prompt).strip()
-        
-        logger.debug(f"[QwenImage] 清理后的提示词: {clean_prompt}")
-        return clean_prompt
-
-    def extract_negative_prompt(self, prompt: str) -> str:
-        """从用户提示词中提取负面提示词"""
-        # 尝试从提示词中提取负面提示词
-        match = re.search(r'--负面提示：(.+?)(?=\s*--|\s*$)', prompt)
-        if match:
-            negative_prompt = match.group(1).strip()
-            logger.debug(f"[QwenImage] 从提示词中提取负面提示词: {negative_prompt}")
-            return negative_prompt
-        else:
-            # 如果没有负面提示词，则使用默认的负面提示词
-            logger.debug(f"[QwenImage] 使用默认负面提示词: {self.default_negative_prompt}")
-            return self.default_negative_prompt
-
-    def extract_ratio_from_prompt(self, prompt: str) -> str:
-        """从用户提示词中直接提取比例信息"""
-        match = re.search(r'--ar (\d+:\d+)', prompt)
-        if match:
-            return match.group(1)
+                reply = f"✅ 进行中的任务已全部完成，可以安全重启。发送 {resume_prefix} 恢复服务"
+        elif content.startswith(resume_prefix):
+            self.admission.resume()
+            slog.info("恢复受理新任务", session=session_id)
+            reply = "▶️ 已恢复受理新任务"
         else:
-            return self.default_ratio  # 返回默认比例
-
-    def generate_image(self, prompt: str, image_size: str, model: str, prompt_extend: bool, negative_prompt: str) -> str:
-        """调用Qwen Image API生成图片"""
-        logger.info(f"[QwenImage] 准备调用Qwen Image API生成图片，模型: {model}, 尺寸: {image_size}, 智能改写: {prompt_extend}, 负面提示词: {negative_prompt}, 当前账号: {self.current_account}")
-
-        # 构建请求体
-        payload = {
-            "model": model,
-            "input": {
-                "prompt": prompt,
-                "negative_prompt": negative_prompt
-            },
-            "parameters": {
-                "size": image_size.replace('x', '*'),  # 将1024x1024转换为1024*1024
-                "n": 1,
-                "watermark": False,
-                "prompt_extend": prompt_extend
-            }
-        }
-
-        headers = {
-            "X-DashScope-Async": "enable",
-            "Authorization": f"Bearer {self.current_api_key}",
-            "Content-Type": "application/json"
-        }
-
-        logger.debug(f"[QwenImage] 发送请求体: {payload}")
-        logger.info(f"[QwenImage] 使用API URL: {self.base_url}")
+            reply = "❓ 未知的管理命令"
+        e_context["reply"] = Reply(ReplyType.TEXT, reply)
 
-        try:
-            # 提交任务
-            response = requests.post(self.base_url, headers=headers, json=payload, timeout=180)
-            response.raise_for_status()
-            task_data = response.json()
-            
-            # 获取任务ID
-            task_id = task_data.get("output", {}).get("task_id")
-            if not task_id:
-                logger.error("❌ 未获取到任务ID")
-                raise Exception("API响应中未获取到任务ID")
-            
-            logger.info(f"✅ 任务提交成功，任务ID: {task_id}")
-            
-            # 轮询任务结果
-            return self._poll_task_result(task_id)
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"[QwenImage] API请求失败: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                logger.error(f"[QwenImage] API响应状态码: {e.response.status_code}")
-                logger.error(f"[QwenImage] API响应内容: {e.response.text}")
-            raise Exception(f"API请求失败: {str(e)}")
-
-    def _poll_task_result(self, task_id: str, max_retries: int = 60, retry_interval: int = 2) -> str:
-        """轮询任务结果，获取生成的图像URL"""
-        poll_url = f"https://dashscope.aliyuncs.com/api/v1/tasks/{task_id}"
-        headers = {
-            "Authorization": f"Bearer {self.current_api_key}"
-        }
-        
-        for attempt in range(max_retries):
-            try:
-                response = requests.get(poll_url, headers=headers, timeout=30)
-                response.raise_for_status()
-                result_data = response.json()
-                
-                task_status = result_data.get("output", {}).get("task_status")
-                
-                if task_status == "SUCCEEDED":
-                    # 任务成功，获取结果图像
-                    results = result_data.get("output", {}).get("results", [])
-                    if results and len(results) > 0:
-                        image_url = results[0].get("url")
-                        if image_url:
-                            logger.info("✅ 任务成功，获取到图像URL")
-                            logger.info(f"🖼️ 图像URL: {image_url}")
-                            return image_url
-                        else:
-                            logger.error("❌ 图像URL为空")
-                            raise Exception("图像URL为空")
-                    else:
-                        logger.error("❌ 没有获取到结果")
-                        raise Exception("没有获取到结果")
-                
-                elif task_status == "FAILED":
-                    logger.error("❌ 任务执行失败")
-                    error_code = result_data.get("output", {}).get("error_code", "未知")
-                    error_message = result_data.get("output", {}).get("error_message", "未知")
-                    raise Exception(f"任务执行失败: {error_code} - {error_message}")
-                
-                elif task_status in ["PENDING", "RUNNING"]:
-                    # 任务还在进行中，等待后重试
-                    if attempt % 10 == 0:  # 每10次重试打印一次状态
-                        logger.info(f"⏳ 任务进行中... (第{attempt+1}次检查)")
-                    time.sleep(retry_interval)
-                    continue
-                
-                else:
-                    logger.warning(f"⚠️ 未知任务状态: {task_status}")
-                    time.sleep(retry_interval)
-                    continue
-                    
-            except requests.exceptions.RequestException as e:
-                logger.error(f"❌ 轮询请求失败: {e}")
-                time.sleep(retry_interval)
-                continue
-            except Exception as e:
-                logger.error(f"❌ 轮询处理失败: {e}")
-                time.sleep(retry_interval)
-                continue
-        
-        logger.error("❌ 轮询超时")
-        raise Exception("轮询超时，请稍后手动查询任务状态")
+    def reload(self):
+        """按启动时相同的优先级从磁盘重新读取配置（全局plugins/config.json中的本插件配置优先，
+        其次是插件目录下的config.json），原子替换编译配置并返回新配置
 
-    def edit_image(self, image_content, edit_prompt):
-        """调用Qwen Image Edit API编辑图片
-        Args:
-            image_content: 可以是文件路径(str)或图片二进制数据(bytes)
-            edit_prompt: 编辑指令
+        框架的load_config()读取的是加载插件时缓存的全局配置，这里直接读取文件，修改全局配置后同样生效。
+        进行中的任务、线程池、连接池、熔断状态、任务统计和用量记录均保留；配置不合法时抛出异常并保留原配置。
         """
-        logger.info(f"[QwenImage] 准备调用Qwen Image Edit API编辑图片，模型: {self.default_edit_model}")
-        logger.info(f"[QwenImage] 编辑指令: {edit_prompt}")
-
-        if not self.current_api_key:
-            logger.error("[QwenImage] 未配置Qwen API Key")
-            raise Exception("未配置API Key")
+        return self.reload_config(self._read_config())
+
+    def _read_config(self) -> dict:
+        """读取磁盘上的插件配置，查找顺序与框架的Plugin.load_config()一致"""
+        global_path = os.path.join(os.path.dirname(self.path), "config.json")
+        if os.path.exists(global_path):
+            # 框架按插件名（不区分大小写）查找全局配置
+            global_conf = {name.lower(): conf for name, conf in load_config_file(global_path).items()}
+            conf = global_conf.get(self.name.lower())
+            if conf:
+                return conf
+        return load_config_file(os.path.join(self.path, "config.json"))
+
+    def drain(self, grace_period: float = None) -> int:
+        """停止受理新任务，最多等待grace_period秒让进行中的任务完成，返回仍未完成的任务数"""
+        if grace_period is None:
+            grace_period = self.config.drain.get("grace_period", 60)
+        slog.info("开始排空，暂停受理新任务", in_flight=self.admission.in_flight, grace_period=grace_period)
+        remaining = self.admission.drain(grace_period)
+        if remaining:
+            slog.warning("宽限期已到，仍有任务未完成", remaining=remaining)
+        else:
+            slog.info("排空完成，进行中的任务已全部完成")
+        return remaining
 
+    def _admit(self, e_context: EventContext, handler, *args):
+        """经过受理闸门执行生成任务，排空期间直接回复稍后再试"""
         try:
-            # 将图片内容转换为base64格式
-            image_base64 = self._process_image_to_base64(image_content)
-            logger.info(f"[QwenImage] 📷 图片已转换为base64格式")
-        except Exception as e:
-            logger.error(f"[QwenImage] ❌ 图片转base64失败: {e}")
-            raise Exception(f"图片转base64失败 - {e}")
-
-        # 构造API请求，参考ComfyUI节点的实现
-        payload = {
-            "model": self.default_edit_model,
-            "input": {
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "image": image_base64
-                            },
-                            {
-                                "text": edit_prompt
-                            }
-                        ]
-                    }
-                ]
-            },
-            "parameters": {
-                "negative_prompt": self.default_negative_prompt,
-                "prompt_extend": True,
-                "watermark": False
-            }
-        }
-
-        headers = {
-            "Authorization": f"Bearer {self.current_api_key}",
-            "Content-Type": "application/json"
-        }
-
-        logger.debug(f"[QwenImage] 发送请求体: {payload}")
-        logger.info(f"[QwenImage] 使用API URL: {self.edit_base_url}")
+            with self.admission.admit():
+                handler(e_context, *args)
+        except DrainingError as e:
+            slog.info("排空期间拒绝新任务", content=e_context["context"].content)
+            e_context["reply"] = Reply(ReplyType.TEXT, f"⏳ {e}")
+            e_context.action = EventAction.BREAK_PASS
 
-        try:
-            # 发送请求
-            logger.info("[QwenImage] 🚀 发送API请求...")
-            response = requests.post(self.edit_base_url, headers=headers, json=payload, timeout=180)
-            response.raise_for_status()
-            
-            result_data = response.json()
-            logger.info("[QwenImage] ✅ API请求成功")
-            
-            # 解析响应，参考ComfyUI节点的实现
-            choices = result_data.get("output", {}).get("choices", [])
-            if choices and len(choices) > 0:
-                content = choices[0].get("message", {}).get("content", [])
-                
-                # 查找图像内容
-                image_content = None
-                for item in content:
-                    if "image" in item:
-                        image_content = item["image"]
-                        break
-                
-                if image_content:
-                    logger.info("[QwenImage] 🖼️ 获取到编辑结果")
-                    logger.info(f"🖼️ 图像URL: {image_content}")
-                    return image_content
-                else:
-                    logger.error("[QwenImage] ❌ 响应中未找到图像内容")
-                    raise Exception("响应中未找到图像内容")
-            else:
-                logger.error("[QwenImage] ❌ 响应格式异常")
-                raise Exception("响应格式异常")
-                
-        except requests.exceptions.RequestException as e:
-            logger.error(f"[QwenImage] ❌ API请求失败: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                logger.error(f"[QwenImage] API响应状态码: {e.response.status_code}")
-                logger.error(f"[QwenImage] API响应内容: {e.response.text}")
-            raise Exception(f"API请求失败: {str(e)}")
-
-    def _process_image_to_base64(self, image_content):
-        """将图像内容转换为base64格式"""
-        try:
-            # 如果image_content是文件路径，直接读取文件
-            if isinstance(image_content, str) and os.path.exists(image_content):
-                with open(image_content, 'rb') as image_file:
-                    image_data = image_file.read()
-            # 如果image_content是URL，下载图片
-            elif isinstance(image_content, str) and (image_content.startswith('http://') or image_content.startswith('https://')):
-                response = requests.get(image_content, timeout=60)
-                response.raise_for_status()
-                image_data = response.content
-            # 如果image_content是bytes数据
-            elif isinstance(image_content, bytes):
-                image_data = image_content
-            else:
-                # 尝试处理其他格式
-                logger.warning(f"[QwenImage] 未知的图像内容格式: {type(image_content)}")
-                # 如果是字符串，假设是base64编码的图片数据
-                if isinstance(image_content, str):
-                    try:
-                        image_data = base64.b64decode(image_content)
-                    except:
-                        raise Exception(f"无法处理的图像内容格式: {type(image_content)}")
-                else:
-                    raise Exception(f"无法处理的图像内容格式: {type(image_content)}")
-            
-            # 验证图片格式并转换为JPEG
-            img = Image.open(BytesIO(image_data))
-            
-            # 确保是RGB格式
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # 保存为JPEG格式并转换为base64
-            output_buffer = BytesIO()
-            img.save(output_buffer, format="JPEG", quality=95)
-            image_data_bytes_jpeg = output_buffer.getvalue()
-            image_base64 = base64.b64encode(image_data_bytes_jpeg).decode('utf-8')
-            
-            return f"data:image/jpeg;base64,{image_base64}"
-            
-        except Exception as e:
-            logger.error(f"[QwenImage] 图像转换失败: {e}")
-            raise
+    def _install_sigterm_drain(self):
+        """收到SIGTERM时先排空再交给原来的信号处理函数；信号处理函数只能在主线程中注册"""
+        if threading.current_thread() is not threading.main_thread():
+            logger.warning("[QwenImage] 插件不在主线程中初始化，无法注册SIGTERM排空")
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            self.drain()
+            if callable(previous):
+                previous(signum, frame)
+            elif previous == signal.SIG_DFL:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+    def _supersede_progressive_job(self, session_id: str):
+        """取消该会话仍在等待的渐进模式最终任务，排队中的任务同时在服务端取消"""
+        deadline = self.progressive_jobs.pop(session_id, None)
+        if deadline is not None:
+            slog.info("同一会话发起了新命令，取消上一张图片的最终任务", session=session_id)
+            deadline.cancel()
+
+    def _record_first_image(self, deadline: Deadline):
+        """记录从受理到首张图片交付的耗时"""
+        self._incr_stat("first_images")
+        self._incr_stat("first_image_seconds", deadline.elapsed())
+
+    def _deadline_message(self, e: DeadlineExceeded) -> str:
+        """生成面向用户的超时提示"""
+        message = f"⏰ 任务超过 {self.job_deadline} 秒仍未完成，已停止等待。"
+        if e.cancelled:
+            message += "排队中的任务已取消，不会产生费用。"
+        message += "请稍后重试。"
+        return message
 
     def _get_referenced_image_data(self, referenced_image_path: str):
         """获取引用图片的数据
@@ -791,7 +640,7 @@ class QwenImage(Plugin):
             # 如果是网络URL，下载图片
             if referenced_image_path.startswith('http://') or referenced_image_path.startswith('https://'):
                 logger.info(f"[QwenImage] 下载引用图片: {referenced_image_path}")
-                response = requests.get(referenced_image_path, timeout=30)
+                response = self.http.get(referenced_image_path, timeout=30)
                 if response.status_code == 200:
                     return response.content
             
@@ -847,9 +696,13 @@ class QwenImage(Plugin):
         # 控制功能
         help_text += "【控制功能】\n"
         help_text += f"1. 使用 {', '.join(self.control_prefixes)} 控制智能扩写开关\n"
-        help_text += f"2. 使用 {', '.join(self.account_prefixes)} 切换API账号\n\n"
+        help_text += f"2. 使用 {', '.join(self.account_prefixes)} 切换API账号\n"
+        help_text += f"3. 使用 {', '.join(self.stats_prefixes)} 查看任务统计\n"
+        help_text += f"4. 使用 {', '.join(self.preview_prefixes)} 控制快速预览开关：使用 {self.default_model} 模型时先发送快速预览图，再发送最终图片\n\n"
         
         help_text += "注意：智能改写功能对短提示词效果提升明显\n"
         help_text += "注意：如果不指定负面提示词，将使用默认的负面提示词\n"
         help_text += "注意：图像编辑功能需要在3分钟内上传图片，超时后需要重新发起请求\n"
+        help_text += f"注意：单个任务超过 {self.job_deadline} 秒未完成将停止等待，排队中的任务会被自动取消\n"
+        help_text += "注意：开启快速预览后，在最终图片完成前发起新的绘图或改图命令，将取消上一张图片的最终任务，已发送的预览图照常计费\n"
         return help_text 
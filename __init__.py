@@ -1 +1,7 @@
-from .QwenImage import *
\ No newline at end of file
+try:
+    import plugins  # noqa: F401
+except ImportError:
+    # 脱离机器人框架运行（如批量CLI）时只提供生成引擎，不注册插件
+    pass
+else:
+    from .QwenImage import *
@@ -0,0 +1,68 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class DrainingError(Exception):
+    """插件正在排空（更新或重启前），暂不受理新任务"""
+
+
+class AdmissionGate:
+    """生成任务的受理闸门
+
+    正常时受理所有任务并统计进行中的任务数；排空时拒绝新任务，
+    等待进行中的任务（提交、轮询、交付）在宽限期内完成。
+    """
+
+    def __init__(self):
+        self._draining = False
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def draining(self) -> bool:
+        return self._draining
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @contextmanager
+    def admit(self):
+        """受理一个任务，排空期间抛出DrainingError"""
+        self.begin()
+        try:
+            yield
+        finally:
+            self.finish()
+
+    def begin(self, check_draining: bool = True):
+        """计入一个进行中的任务，需与finish()成对调用，可以在不同线程中结束；
+        check_draining为False用于已受理任务派生的后台子任务（如快速预览），排空期间同样计入"""
+        with self._condition:
+            if check_draining and self._draining:
+                raise DrainingError("插件正在更新，请稍后再试")
+            self._in_flight += 1
+
+    def finish(self):
+        """结束一个进行中的任务"""
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def drain(self, grace_period: float) -> int:
+        """停止受理新任务，最多等待grace_period秒让进行中的任务完成，返回仍未完成的任务数"""
+        expires_at = time.monotonic() + grace_period
+        with self._condition:
+            self._draining = True
+            while self._in_flight:
+                remaining = expires_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._in_flight
+
+    def resume(self):
+        """恢复受理新任务"""
+        with self._condition:
+            self._draining = False
@@ -0,0 +1,378 @@
+"""QwenImage 性能基准
+
+用法（在插件目录下运行，不需要启动机器人，也不会调用API）:
+    python bench.py parser    # 命令路由与参数解析：每条消息的耗时（与原实现的一致性由 tests/test_command_parser.py 校验）
+    python bench.py logging   # 请求热路径日志：每个请求的CPU耗时、内存分配和输出字节数
+    python bench.py startup   # 启动与首个请求：全新解释器中的导入耗时、配置编译、首条命令和首次改图的耗时
+"""
+import argparse
+import base64
+import importlib
+import logging
+import os
+import re
+import statistics
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+import zlib
+
+if __name__ == "__main__" and not __package__:
+    # 以脚本方式运行时，把插件目录作为包导入，以便使用相对导入
+    _plugin_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path[0] = os.path.dirname(_plugin_dir)
+    __package__ = os.path.basename(_plugin_dir)
+    importlib.import_module(__package__)
+
+from .command_parser import PrefixTrie, PromptParser
+from .compiled_config import compile_config
+from .engine import QwenImageEngine, load_config_file
+from .structured_log import StructuredLogger, request_context
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(PLUGIN_DIR, "config.json.template")
+
+# 不带命令前缀的普通群聊消息
+CHAT_MESSAGES = [
+    "今天中午吃什么",
+    "哈哈哈哈哈哈",
+    "Q",
+    "@机器人 帮我查一下天气",
+    "有人看昨晚的比赛了吗？最后那个球太精彩了，完全没想到能逆转" * 3,
+    "[图片]",
+    "QQ群里有人在吗",
+]
+
+# 带命令前缀的消息
+COMMAND_MESSAGES = [
+    "Q画图 一只可爱的小猫",
+    "Q画 一张酷炫的电影海报 --ar 3:4 --plus",
+    "Q生成 快速生成的风景画 --ar 16:9 --flash",
+    "Q画图 美丽的花朵 --负面提示：模糊，低质量",
+    "Q改图 将背景改成海滩场景",
+    "Q开启智能扩写",
+    "Q切换账号 2",
+    "Q任务统计",
+]
+
+class LegacyParser:
+    """原实现的参数解析，作为性能对比的基准；tests/test_command_parser.py 用它校验新实现的解析结果完全一致"""
+
+    def __init__(self, ratios, default_ratio, models, default_model, default_negative_prompt):
+        self.ratios = ratios
+        self.default_ratio = default_ratio
+        self.models = models
+        self.default_model = default_model
+        self.default_negative_prompt = default_negative_prompt
+
+    def parse(self, content):
+        return (self.clean_prompt_string(content), self.extract_image_size(content),
+                self.extract_model(content), self.extract_negative_prompt(content))
+
+    def extract_image_size(self, prompt):
+        match = re.search(r'--ar (\d+:\d+)', prompt)
+        if match:
+            ratio = match.group(1).strip()
+            if ratio in self.ratios:
+                return f"{self.ratios[ratio]['width']}x{self.ratios[ratio]['height']}"
+        return f"{self.ratios[self.default_ratio]['width']}x{self.ratios[self.default_ratio]['height']}"
+
+    def extract_model(self, prompt):
+        if "--flash" in prompt:
+            for model in self.models:
+                if "flash" in model.lower():
+                    return model
+        elif "--plus" in prompt:
+            for model in self.models:
+                if "plus" in model.lower():
+                    return model
+        return self.default_model
+
+    def clean_prompt_string(self, prompt):
+        clean_prompt = re.sub(r'--ar \d+:\d+', '', prompt)
+        clean_prompt = clean_prompt.replace('--plus', '')
+        clean_prompt = clean_prompt.replace('--flash', '')
+        clean_prompt = re.sub(r'--负面提示：[^，。！？]*', '', clean_prompt)
+        return re.sub(r'\s+', ' ', clean_prompt).strip()
+
+    def extract_negative_prompt(self, prompt):
+        match = re.search(r'--负面提示：(.+?)(?=\s*--|\s*$)', prompt)
+        if match:
+            return match.group(1).strip()
+        return self.default_negative_prompt
+
+    def extract_ratio_from_prompt(self, prompt):
+        match = re.search(r'--ar (\d+:\d+)', prompt)
+        if match:
+            return match.group(1)
+        return self.default_ratio
+
+
+def legacy_route(content, prefix_lists):
+    """原实现的命令分发：每条消息都重新构建前缀元组"""
+    for command, prefixes in prefix_lists:
+        if content.startswith(tuple(prefixes)):
+            return command
+    return None
+
+
+def trie_route(content, trie, commands):
+    matched = trie.match(content) if content else None
+    if not matched:
+        return None
+    for command in commands:
+        if command in matched:
+            return command
+    return None
+
+
+def timeit(func, messages, rounds):
+    """返回处理每条消息的平均耗时（微秒）"""
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            func(message)
+    return (time.perf_counter() - started) / (rounds * len(messages)) * 1e6
+
+
+def bench_parser(args):
+    conf = load_config_file(TEMPLATE_PATH)
+    qwen_config = conf["qwen_image"]
+    parser_args = (qwen_config["ratios"], qwen_config["default_ratio"], qwen_config["model"], "qwen-image",
+                   qwen_config["default_negative_prompt"])
+    legacy = LegacyParser(*parser_args)
+    parser = PromptParser(*parser_args)
+
+    prefix_lists = [("draw", conf["image_command"]), ("edit", conf["image_edit_command"]),
+                    ("control", conf["control_command"]), ("account", conf["account_command"]),
+                    ("stats", conf["stats_command"])]
+    commands = [command for command, _ in prefix_lists]
+    trie = PrefixTrie()
+    for command, prefixes in prefix_lists:
+        for prefix in prefixes:
+            trie.add(prefix, command)
+
+    # 普通消息只经过路由；命令消息经过路由 + 参数解析（含进度提示中的比例提取）
+    def legacy_command(message):
+        legacy_route(message, prefix_lists)
+        content = message.split(" ", 1)[-1]
+        legacy.parse(content)
+        legacy.extract_ratio_from_prompt(message)
+
+    def new_command(message):
+        trie_route(message, trie, commands)
+        content = message.split(" ", 1)[-1]
+        parser.parse(content)
+        parser.ratio(message)
+
+    rounds = args.rounds
+    print(f"{'场景':<16}{'原实现(us/条)':>16}{'新实现(us/条)':>16}{'加速':>8}")
+    for name, messages, old, new in (
+            ("普通消息路由", CHAT_MESSAGES, lambda m: legacy_route(m, prefix_lists), lambda m: trie_route(m, trie, commands)),
+            ("命令路由+解析", COMMAND_MESSAGES, legacy_command, new_command)):
+        old_cost = timeit(old, messages, rounds)
+        new_cost = timeit(new, messages, rounds)
+        print(f"{name:<16}{old_cost:>16.3f}{new_cost:>16.3f}{old_cost / new_cost:>7.1f}x")
+    return 0
+
+
+class _CountingStream:
+    """只统计写入字节数的日志输出"""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, text):
+        self.bytes += len(text)
+
+    def flush(self):
+        pass
+
+
+def _legacy_request_logs(logger, payload, task_id, image_url, polls):
+    """原实现中一次图像编辑 + 一次文生图轮询在热路径上的日志调用"""
+    logger.info(f"[QwenImage] 准备调用Qwen Image Edit API编辑图片，模型: qwen-image-edit")
+    logger.info(f"[QwenImage] 编辑指令: {payload['input']['messages'][0]['content'][1]['text']}")
+    logger.info(f"[QwenImage] 📷 图片已转换为base64格式")
+    logger.debug(f"[QwenImage] 发送请求体: {payload}")
+    logger.info(f"[QwenImage] 使用API URL: https://dashscope.aliyuncs.com/api/v1/services/aigc/multimodal-generation/generation")
+    logger.info("[QwenImage] 🚀 发送API请求...")
+    logger.info("[QwenImage] ✅ API请求成功")
+    logger.info("[QwenImage] 🖼️ 获取到编辑结果")
+    logger.info(f"🖼️ 图像URL: {image_url}")
+    logger.debug(f"[QwenImage] 解析用户输入: 尺寸=1328x1328, 模型=qwen-image, 智能改写=True, 负面提示词={payload['parameters']['negative_prompt']}, 清理后的提示词=一只猫")
+    logger.info(f"✅ 任务提交成功，任务ID: {task_id}")
+    for attempt in range(polls):
+        if attempt % 10 == 0:
+            logger.info(f"⏳ 任务进行中... (第{attempt+1}次检查)")
+    logger.info("✅ 任务成功，获取到图像URL")
+    logger.info(f"🖼️ 图像URL: {image_url}")
+
+
+def _structured_request_logs(slog, payload, task_id, image_url, polls):
+    """同样的请求使用结构化日志"""
+    with request_context():
+        slog.info("准备调用Qwen Image Edit API编辑图片", model="qwen-image-edit", prompt=payload['input']['messages'][0]['content'][1]['text'])
+        slog.debug("📷 图片已转换为base64格式", length=len(payload['input']['messages'][0]['content'][0]['image']))
+        slog.debug("发送请求体", payload=payload)
+        slog.info("使用API URL", url="https://dashscope.aliyuncs.com/api/v1/services/aigc/multimodal-generation/generation", account=1)
+        slog.debug("🚀 发送API请求")
+        slog.info("✅ API请求成功", elapsed=lambda: "12.3s")
+        slog.info("🖼️ 获取到编辑结果", url=image_url)
+        slog.debug("解析用户输入", size="1328x1328", model="qwen-image", prompt_extend=True, negative_prompt=payload['parameters']['negative_prompt'], prompt="一只猫")
+        slog.info("✅ 任务提交成功", task_id=task_id, account=1)
+        for attempt in range(polls):
+            if attempt % 10 == 0:
+                slog.info("⏳ 任务进行中", task_id=task_id, status="RUNNING", attempt=attempt + 1)
+        slog.info("✅ 任务成功，获取到图像URL", task_id=task_id, attempts=polls, url=image_url)
+
+
+def bench_logging(args):
+    conf = load_config_file(TEMPLATE_PATH)
+    image_base64 = "data:image/jpeg;base64," + base64.b64encode(os.urandom(args.image_kb * 1024)).decode()
+    payload = {
+        "model": "qwen-image-edit",
+        "input": {"messages": [{"role": "user", "content": [{"image": image_base64}, {"text": "将背景改成海滩场景"}]}]},
+        "parameters": {"negative_prompt": conf["qwen_image"]["default_negative_prompt"], "prompt_extend": True, "watermark": False},
+    }
+    task_id = "0385dc79-5ff8-4d82-bcb6-caf6b1ce2ece"
+    image_url = "https://dashscope-result.oss-cn-beijing.aliyuncs.com/1d/7b/20250818/example.png?Expires=1755600000&OSSAccessKeyId=LTAI&Signature=abc"
+
+    print(f"每个请求：一次图像编辑（图片 {args.image_kb}KB，base64 {len(image_base64) // 1024}KB）+ 一次文生图轮询 {args.polls} 次")
+    print(f"{'日志级别':<10}{'实现':<8}{'CPU(us/请求)':>14}{'分配峰值(KB)':>14}{'输出(字节/请求)':>16}")
+    for level_name in ("INFO", "DEBUG"):
+        for name in ("原实现", "结构化"):
+            stream = _CountingStream()
+            base_logger = logging.Logger(f"bench-{level_name}-{name}", getattr(logging, level_name))
+            handler = logging.StreamHandler(stream)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+            base_logger.addHandler(handler)
+            if name == "原实现":
+                def run():
+                    _legacy_request_logs(base_logger, payload, task_id, image_url, args.polls)
+            else:
+                slog = StructuredLogger(base_logger)
+
+                def run():
+                    _structured_request_logs(slog, payload, task_id, image_url, args.polls)
+            rounds = max(1, args.rounds // 100)
+            started = time.process_time()
+            for _ in range(rounds):
+                run()
+            cpu = (time.process_time() - started) / rounds * 1e6
+            output = stream.bytes / rounds
+            tracemalloc.start()
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{level_name:<10}{name:<8}{cpu:>14.1f}{peak / 1024:>14.1f}{output:>16.0f}")
+    return 0
+
+
+# 在全新的解释器中导入模块，输出导入耗时以及导入后是否已加载PIL
+_IMPORT_PROBE = """
+import importlib, sys, time
+sys.path.insert(0, {parent!r})
+started = time.perf_counter()
+for module in {modules!r}:
+    importlib.import_module(module)
+print(time.perf_counter() - started, "PIL" in sys.modules)
+"""
+
+
+def _import_seconds(modules, runs):
+    """返回多次冷启动导入耗时的中位数，以及导入后是否加载了PIL"""
+    probe = _IMPORT_PROBE.format(parent=os.path.dirname(PLUGIN_DIR), modules=list(modules))
+    samples = []
+    pil_loaded = False
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, check=True).stdout.split()
+        samples.append(float(output[0]))
+        pil_loaded = output[1] == "True"
+    return statistics.median(samples), pil_loaded
+
+
+def _solid_png(width, height):
+    """不依赖PIL构造一张纯色PNG，作为首次改图的输入"""
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    rows = b"".join(b"\x00" + b"\x80\x40\x20" * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+
+def bench_startup(args):
+    engine_module = f"{__package__}.engine"
+    print(f"{'冷启动导入（' + str(args.runs) + '次中位数）':<30}{'耗时(ms)':>10}{'已加载PIL':>10}")
+    for name, modules in (("引擎模块", [engine_module]),
+                          ("引擎模块 + PIL（原实现启动时导入）", ["PIL.Image", engine_module])):
+        seconds, pil_loaded = _import_seconds(modules, args.runs)
+        print(f"{name:<30}{seconds * 1000:>10.1f}{'是' if pil_loaded else '否':>10}")
+
+    conf = load_config_file(TEMPLATE_PATH)
+    conf["api_key_1"] = "sk-bench"
+    conf["usage"] = {"file": ""}  # 不读写用量文件
+    rounds = max(1, args.rounds // 100)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        compile_config(conf)
+    compile_cost = (time.perf_counter() - started) / rounds
+    started = time.perf_counter()
+    engine = QwenImageEngine(conf)
+    init_cost = time.perf_counter() - started
+
+    # 首条命令：前缀树路由 + 参数解析 + 进度提示中的比例提取，与之后的稳态耗时对比
+    message = "Q画 一张酷炫的电影海报 --ar 3:4 --plus"
+    context = {"session_id": "bench"}
+
+    def command():
+        engine.config.command_trie.match(message)
+        engine.parse_user_input(message.split(" ", 1)[-1], context)
+        engine.extract_ratio_from_prompt(message)
+
+    started = time.perf_counter()
+    command()
+    first_command = time.perf_counter() - started
+    steady_command = timeit(lambda _: command(), [message], rounds) / 1e6
+
+    # 首次改图：图片预处理（首次调用时才导入PIL），与第二次调用对比
+    image = _solid_png(args.image_size, args.image_size)
+    started = time.perf_counter()
+    engine._process_image_to_base64(image)
+    first_edit = time.perf_counter() - started
+    started = time.perf_counter()
+    engine._process_image_to_base64(image)
+    steady_edit = time.perf_counter() - started
+
+    print(f"{'首个请求':<30}{'首次(ms)':>10}{'稳态(ms)':>10}")
+    print(f"{'编译配置':<30}{compile_cost * 1000:>10.3f}{'-':>10}")
+    print(f"{'初始化引擎（含编译配置）':<30}{init_cost * 1000:>10.3f}{'-':>10}")
+    print(f"{'首条绘图命令路由+解析':<30}{first_command * 1000:>10.3f}{steady_command * 1000:>10.3f}")
+    print(f"{'首次改图图片预处理（' + str(args.image_size) + 'px）':<30}{first_edit * 1000:>10.1f}{steady_edit * 1000:>10.1f}")
+    engine._executor.shutdown()
+    return 0
+
+
+BENCHMARKS = {
+    "parser": bench_parser,
+    "logging": bench_logging,
+    "startup": bench_startup,
+}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="QwenImage 性能基准")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS), help="要运行的基准")
+    parser.add_argument("--rounds", type=int, default=20000, help="每个场景的重复轮数")
+    parser.add_argument("--image-kb", type=int, default=2048, help="logging基准中编辑图片的大小（KB）")
+    parser.add_argument("--polls", type=int, default=30, help="logging基准中每个任务的轮询次数")
+    parser.add_argument("--runs", type=int, default=5, help="startup基准中冷启动导入的测量次数")
+    parser.add_argument("--image-size", type=int, default=512, help="startup基准中首次改图的图片边长（像素）")
+    args = parser.parse_args(argv)
+    return BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
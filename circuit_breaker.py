@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import deque
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求被快速拒绝"""
+
+
+class CircuitBreaker:
+    """基于滚动窗口错误率和延迟的熔断器
+
+    closed: 正常放行，窗口内失败率（慢调用也计为失败）达到阈值时打开
+    open: 快速失败，冷却时间结束后进入half_open
+    half_open: 只放行一个探测请求，成功则关闭，失败则重新打开；
+               探测请求超过冷却时间仍未返回结果时，允许再放行一个
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, window: float = 60, min_calls: int = 5, error_rate: float = 0.5,
+                 slow_call_seconds: float = 30, cooldown: float = 30):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.cooldown = cooldown
+        self._samples = deque()  # (时间戳, 是否成功, 延迟)
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def allow(self) -> bool:
+        """是否放行本次请求；half_open状态下只放行一个探测请求"""
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and (not self._probe_in_flight or now - self._probe_started >= self.cooldown):
+                self._probe_in_flight = True
+                self._probe_started = now
+                return True
+            return False
+
+    def record(self, ok: bool, latency: float = None):
+        """记录一次调用结果。latency为None时不参与慢调用判断和延迟统计"""
+        now = time.monotonic()
+        failed = not ok or (latency is not None and latency >= self.slow_call_seconds)
+        with self._lock:
+            if self._current_state(now) == self.HALF_OPEN:
+                self._probe_in_flight = False
+                if failed:
+                    self._open(now)
+                    return
+                self._state = self.CLOSED
+                self._samples.clear()
+            self._samples.append((now, not failed, latency))
+            self._trim(now)
+            if self._state == self.CLOSED and len(self._samples) >= self.min_calls:
+                failures = sum(1 for _, success, _ in self._samples if not success)
+                if failures / len(self._samples) >= self.error_rate:
+                    self._open(now)
+
+    def latency_percentile(self, percentile: float):
+        """窗口内成功调用的延迟分位数，样本不足时返回None"""
+        with self._lock:
+            self._trim(time.monotonic())
+            latencies = sorted(latency for _, success, latency in self._samples if success and latency is not None)
+        if len(latencies) < self.min_calls:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            total = len(self._samples)
+            failures = sum(1 for _, success, _ in self._samples if not success)
+            return {
+                "state": self._current_state(now),
+                "calls": total,
+                "error_rate": failures / total if total else 0.0,
+            }
+
+    def _current_state(self, now: float) -> str:
+        if self._state == self.OPEN and now - self._opened_at >= self.cooldown:
+            self._state = self.HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def _open(self, now: float):
+        self._state = self.OPEN
+        self._opened_at = now
+        self._probe_in_flight = False
+        self._samples.clear()
+
+    def _trim(self, now: float):
+        while self._samples and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+
+
+class BreakerRegistry:
+    """按名称（API账号或接口地址）懒加载熔断器"""
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(str(name), **self.settings)
+                self._breakers[name] = breaker
+            return breaker
+
+    def configure(self, **settings):
+        """更新熔断阈值（重新加载配置时调用），已有熔断器保留当前状态和统计窗口"""
+        with self._lock:
+            self.settings = settings
+            breakers = list(self._breakers.values())
+        defaults = CircuitBreaker("")
+        for breaker in breakers:
+            for key in ("window", "min_calls", "error_rate", "slow_call_seconds", "cooldown"):
+                setattr(breaker, key, settings.get(key, getattr(defaults, key)))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {name: breaker.snapshot() for name, breaker in breakers.items()}
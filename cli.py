@@ -0,0 +1,222 @@
+"""QwenImage 批量生成命令行工具
+
+不依赖机器人框架，复用插件的配置、参数解析（--ar/--flash/--plus/--负面提示：）以及文生图/图生图引擎。
+
+用法（在插件目录下运行）:
+    python cli.py prompts.jsonl --out output --concurrency 4
+
+prompts.jsonl 每行一个任务:
+    {"id": "sticker-01", "prompt": "一只可爱的小猫 --ar 1:1 --flash"}
+    {"id": "poster-01", "prompt": "将背景改成海滩场景", "image": "input/poster.png"}
+带 image 字段的任务使用图像编辑模型；可选字段 prompt_extend 覆盖智能扩写设置。
+
+断点文件（默认 <out>/checkpoint.jsonl）记录每个任务的提交和完成状态。中断后重新运行同一命令即可恢复：
+已完成的任务直接跳过，已提交且仍在排队或运行的任务继续轮询原任务ID，不会重复提交；
+服务端已判定失败（如内容审核未通过）的任务记录为失败，重新运行时重新提交。
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+if __name__ == "__main__" and not __package__:
+    # 以脚本方式运行时，把插件目录作为包导入，以便引擎模块使用相对导入
+    _plugin_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path[0] = os.path.dirname(_plugin_dir)
+    __package__ = os.path.basename(_plugin_dir)
+    importlib.import_module(__package__)
+
+from .deadline import Deadline, DeadlineExceeded
+from .engine import QwenImageEngine, TaskFailedError, load_config_file, logger
+from .structured_log import request_context
+
+
+class Checkpoint:
+    """追加写入的断点文件，每个任务以最后一条记录为准"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 中断时可能只写入了半行
+                        continue
+                    self.records[record["id"]] = record
+
+    def get(self, job_id: str):
+        return self.records.get(job_id)
+
+    def write(self, job_id: str, **fields) -> dict:
+        record = {"id": job_id, "time": time.strftime("%Y-%m-%d %H:%M:%S"), **fields}
+        with self._lock:
+            self.records[job_id] = record
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        return record
+
+
+class BatchRunner:
+    """逐个执行批量任务：生成/编辑、下载图片并记录断点"""
+
+    def __init__(self, engine: QwenImageEngine, out_dir: str, checkpoint: Checkpoint):
+        self.engine = engine
+        self.out_dir = out_dir
+        self.checkpoint = checkpoint
+
+    def run_job(self, job: dict) -> dict:
+        # 以任务ID作为日志关联ID
+        with request_context(job["id"]):
+            return self._run_job(job)
+
+    def _run_job(self, job: dict) -> dict:
+        job_id = job["id"]
+        record = self.checkpoint.get(job_id)
+        if record and record["status"] == "done" and os.path.exists(os.path.join(self.out_dir, record["file"])):
+            logger.info(f"[QwenImage] 任务 {job_id} 已完成，跳过")
+            return record
+
+        deadline = Deadline(self.engine.job_deadline)
+        task_id = None
+        try:
+            if record and record["status"] == "submitted":
+                # 上次运行已提交但未完成，继续轮询原任务，不重新提交
+                task_id = record["task_id"]
+                logger.info(f"[QwenImage] 任务 {job_id} 恢复轮询，任务ID: {task_id}")
+                image_url = self.engine.resume_task(task_id, record["account"], deadline=deadline,
+                                                    model=record.get("model"), session_id="cli")
+            elif job.get("image"):
+                # 图像编辑接口为同步接口，没有任务ID，中断后只能重新提交
+                image_url = self.engine.edit_image(job["image"], job["prompt"], deadline=deadline, session_id="cli")
+            else:
+                prompt, image_size, model, prompt_extend, negative_prompt = self.engine.parse_user_input(job["prompt"], {"session_id": "cli"})
+                if not prompt:
+                    raise Exception("提示词为空")
+                if "prompt_extend" in job:
+                    prompt_extend = bool(job["prompt_extend"])
+
+                def on_submitted(submitted_task_id, account):
+                    nonlocal task_id
+                    task_id = submitted_task_id
+                    self.checkpoint.write(job_id, status="submitted", task_id=submitted_task_id, account=account, model=model)
+
+                image_url = self.engine.generate_image(prompt, image_size, model, prompt_extend, negative_prompt,
+                                                       deadline=deadline, on_submitted=on_submitted, session_id="cli")
+            file_name = self.download(job_id, image_url)
+            logger.info(f"[QwenImage] 任务 {job_id} 完成: {file_name}")
+            return self.checkpoint.write(job_id, status="done", file=file_name, url=image_url, task_id=task_id)
+        except DeadlineExceeded as e:
+            if task_id and not e.cancelled and e.status in ("PENDING", "RUNNING"):
+                # 任务仍在服务端排队或运行，保留submitted记录，下次运行继续轮询
+                logger.warning(f"[QwenImage] 任务 {job_id} 超时，任务 {task_id} 仍在运行，下次运行时继续轮询")
+                return {"id": job_id, "status": "timeout", "task_id": task_id, "error": str(e)}
+            logger.error(f"[QwenImage] 任务 {job_id} 超时: {e}")
+            return self.checkpoint.write(job_id, status="failed", task_id=task_id, error=str(e))
+        except TaskFailedError as e:
+            # 任务在服务端已结束但没有图片（如内容审核未通过），记录为失败，下次运行重新提交
+            logger.error(f"[QwenImage] 任务 {job_id} 执行失败: {e}")
+            return self.checkpoint.write(job_id, status="failed", task_id=task_id, error=str(e),
+                                         error_code=e.error_code, task_status=e.status)
+        except Exception as e:
+            logger.error(f"[QwenImage] 任务 {job_id} 失败: {e}")
+            return self.checkpoint.write(job_id, status="failed", task_id=task_id, error=str(e))
+
+    def download(self, job_id: str, image_url: str) -> str:
+        """下载图片到输出目录，先写临时文件再重命名，避免中断后留下不完整的图片"""
+        extension = os.path.splitext(urlparse(image_url).path)[1] or ".png"
+        file_name = f"{job_id}{extension}"
+        path = os.path.join(self.out_dir, file_name)
+        response = self.engine.http.get(image_url, timeout=60)
+        response.raise_for_status()
+        with open(path + ".part", "wb") as f:
+            f.write(response.content)
+        os.replace(path + ".part", path)
+        return file_name
+
+
+def load_jobs(path: str) -> list:
+    """读取JSONL提示词文件，未指定id时使用行号"""
+    jobs = []
+    seen = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            if not job.get("prompt"):
+                raise ValueError(f"第{line_number}行缺少prompt字段")
+            job["id"] = str(job.get("id", line_number))
+            if job["id"] in seen:
+                raise ValueError(f"第{line_number}行的任务ID重复: {job['id']}")
+            seen.add(job["id"])
+            jobs.append(job)
+    return jobs
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="QwenImage 批量生成：从JSONL读取提示词，批量生成图片并输出结果清单")
+    parser.add_argument("prompts", help="JSONL提示词文件，每行一个任务")
+    parser.add_argument("-c", "--config", help="配置文件路径，默认使用插件目录下的config.json")
+    parser.add_argument("-o", "--out", default="output", help="图片输出目录，默认 output")
+    parser.add_argument("-j", "--concurrency", type=int, default=2, help="并发任务数，默认 2")
+    parser.add_argument("--checkpoint", help="断点文件路径，默认 <out>/checkpoint.jsonl")
+    parser.add_argument("--manifest", help="结果清单路径，默认 <out>/results.jsonl")
+    parser.add_argument("--deadline", type=float, help="单个任务的截止时间（秒），默认使用配置中的job_deadline")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    conf = load_config_file(args.config)
+    # 对冲提交线程池需要能容纳所有并发任务的提交请求
+    conf.setdefault("hedge", {}).setdefault("max_workers", max(8, args.concurrency * 2))
+    if args.deadline:
+        conf["job_deadline"] = args.deadline
+    engine = QwenImageEngine(conf)
+    engine.balance_keys = True
+
+    os.makedirs(args.out, exist_ok=True)
+    checkpoint = Checkpoint(args.checkpoint or os.path.join(args.out, "checkpoint.jsonl"))
+    runner = BatchRunner(engine, args.out, checkpoint)
+    jobs = load_jobs(args.prompts)
+    logger.info(f"[QwenImage] 共 {len(jobs)} 个任务，并发数 {args.concurrency}，账号数 {len(engine.api_keys)}")
+
+    pool = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="QwenImageBatch")
+    try:
+        results = list(pool.map(runner.run_job, jobs))
+    except KeyboardInterrupt:
+        logger.warning("[QwenImage] 已中断，已提交的任务记录在断点文件中，重新运行相同命令即可恢复")
+        pool.shutdown(wait=False, cancel_futures=True)
+        os._exit(130)
+    pool.shutdown()
+
+    manifest_path = args.manifest or os.path.join(args.out, "results.jsonl")
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        for job, result in zip(jobs, results):
+            entry = {"id": job["id"], "prompt": job["prompt"], "image": job.get("image")}
+            entry.update({k: v for k, v in result.items() if k not in ("id", "time")})
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    done = sum(1 for result in results if result["status"] == "done")
+    pending = sum(1 for result in results if result["status"] == "timeout")
+    print(f"完成 {done}/{len(jobs)}，失败 {len(jobs) - done - pending}，超时待恢复 {pending}，结果清单: {manifest_path}")
+    return 0 if done == len(jobs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import re
+from typing import NamedTuple
+
+# 预编译的参数模式，与原先逐个函数中的模式完全一致
+RATIO_PATTERN = re.compile(r'--ar (\d+:\d+)')
+RATIO_STRIP_PATTERN = re.compile(r'--ar \d+:\d+')
+NEGATIVE_PATTERN = re.compile(r'--负面提示：(.+?)(?=\s*--|\s*$)')
+NEGATIVE_STRIP_PATTERN = re.compile(r'--负面提示：[^，。！？]*')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+_EMPTY = frozenset()
+
+
+class PrefixTrie:
+    """命令前缀树：初始化时构建一次，一次遍历即可找出消息匹配的所有命令"""
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, prefix: str, command: str):
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, set()).add(command)
+
+    def match(self, text: str):
+        """返回text开头匹配到的所有命令；不是命令的消息在首字符处即可返回"""
+        node = self._root
+        matched = node.get(None)
+        matched = set(matched) if matched else None
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            commands = node.get(None)
+            if commands:
+                if matched is None:
+                    matched = set()
+                matched.update(commands)
+        return matched or _EMPTY
+
+
+class ParsedPrompt(NamedTuple):
+    prompt: str
+    image_size: str
+    model: str
+    negative_prompt: str
+
+
+class PromptParser:
+    """一次调用解析全部参数：--ar、--flash/--plus、--负面提示：以及清理后的提示词
+
+    结果与原先分别调用 extract_image_size、extract_model、extract_negative_prompt、
+    clean_prompt_string 完全一致。各参数的查找仍按原来的顺序和语义进行（参数之间可能
+    相互重叠，例如负面提示词中包含"--ar"），但只在消息中出现对应的字面量时才运行正则，
+    不带参数的消息只需一次空白折叠。
+    """
+
+    def __init__(self, ratios: dict, default_ratio: str, models: list, default_model: str, default_negative_prompt: str):
+        self.sizes = {ratio: f"{size['width']}x{size['height']}" for ratio, size in ratios.items()}
+        self.default_ratio = default_ratio
+        self.default_size = self.sizes[default_ratio]
+        self.default_model = default_model
+        self.flash_model = next((model for model in models if "flash" in model.lower()), default_model)
+        self.plus_model = next((model for model in models if "plus" in model.lower()), default_model)
+        self.default_negative_prompt = default_negative_prompt
+
+    def parse(self, content: str) -> ParsedPrompt:
+        if "--" not in content:
+            return ParsedPrompt(WHITESPACE_PATTERN.sub(' ', content).strip(), self.default_size,
+                                self.default_model, self.default_negative_prompt)
+        return ParsedPrompt(self.clean_prompt(content), self.image_size(content),
+                            self.model(content), self.negative_prompt(content))
+
+    def ratio(self, content: str) -> str:
+        """提取 --ar 后的比例，未指定时返回默认比例"""
+        if "--ar " in content:
+            match = RATIO_PATTERN.search(content)
+            if match:
+                return match.group(1)
+        return self.default_ratio
+
+    def image_size(self, content: str) -> str:
+        if "--ar " in content:
+            match = RATIO_PATTERN.search(content)
+            if match:
+                return self.sizes.get(match.group(1).strip(), self.default_size)
+        return self.default_size
+
+    def model(self, content: str) -> str:
+        if "--flash" in content:
+            return self.flash_model
+        elif "--plus" in content:
+            return self.plus_model
+        return self.default_model
+
+    def negative_prompt(self, content: str) -> str:
+        if "--负面提示：" in content:
+            match = NEGATIVE_PATTERN.search(content)
+            if match:
+                return match.group(1).strip()
+        return self.default_negative_prompt
+
+    def clean_prompt(self, content: str) -> str:
+        if "--ar " in content:
+            content = RATIO_STRIP_PATTERN.sub('', content)
+        content = content.replace('--plus', '').replace('--flash', '')
+        # 移除模型参数后才可能拼出负面提示词参数，因此在替换后的字符串上判断
+        if "--负面提示：" in content:
+            content = NEGATIVE_STRIP_PATTERN.sub('', content)
+        return WHITESPACE_PATTERN.sub(' ', content).strip()
@@ -0,0 +1,219 @@
+from types import MappingProxyType
+from typing import NamedTuple, Tuple
+
+from .command_parser import PrefixTrie, PromptParser
+
+DEFAULT_RATIOS = {
+    "1:1": {"width": 1328, "height": 1328},
+    "3:4": {"width": 1140, "height": 1472},
+    "4:3": {"width": 1472, "height": 1140},
+    "16:9": {"width": 1664, "height": 928},
+    "9:16": {"width": 928, "height": 1664}
+}
+
+DEFAULT_NEGATIVE_PROMPT = "色调艳丽，过曝，静态，细节模糊不清，风格，画面，整体发灰，最差质量，低质量， JPEG压缩残留，丑陋的，残缺的，多余的手指，杂乱的背景，三条腿"
+
+# 命令名 -> (配置键, 默认前缀)，按分发优先级排列：绘图、图像编辑、控制、快速预览、账号切换、任务统计、管理
+COMMANDS = (
+    ("draw", "image_command", ["Q画图", "Q生成"]),
+    ("edit", "image_edit_command", ["Q改图", "Q编辑"]),
+    ("control", "control_command", ["Q开启智能扩写", "Q禁用智能扩写"]),
+    ("preview", "preview_command", ["Q开启快速预览", "Q关闭快速预览"]),
+    ("account", "account_command", ["Q切换账号 1", "Q切换账号 2"]),
+    ("stats", "stats_command", ["Q任务统计"]),
+    ("admin", "admin_command", ["Q重载配置", "Q暂停服务", "Q恢复服务"]),
+)
+
+
+class ConfigError(Exception):
+    """配置内容不合法"""
+
+
+def _number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _positive_number(value) -> bool:
+    return _number(value) and value > 0
+
+
+def _non_negative_number(value) -> bool:
+    return _number(value) and value >= 0
+
+
+def _positive_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def _prices(value) -> bool:
+    return isinstance(value, dict) and all(isinstance(model, str) and model and _non_negative_number(price)
+                                           for model, price in value.items())
+
+
+def _key_budgets(value) -> bool:
+    return isinstance(value, dict) and all(str(account) in ("1", "2") and _non_negative_number(budget)
+                                           for account, budget in value.items())
+
+
+# 配置段 -> {键: (校验函数, 要求说明)}，段中出现未列出的键同样视为配置错误
+SECTION_SCHEMAS = {
+    "circuit_breaker": {
+        "window": (_positive_number, "正数（秒）"),
+        "min_calls": (_positive_int, "正整数"),
+        "error_rate": (lambda v: _number(v) and 0 < v <= 1, "大于0且不超过1的数"),
+        "slow_call_seconds": (_positive_number, "正数（秒）"),
+        "cooldown": (_positive_number, "正数（秒）"),
+    },
+    "hedge": {
+        "enabled": (lambda v: isinstance(v, bool), "true或false"),
+        "percentile": (lambda v: _number(v) and 0 < v <= 100, "大于0且不超过100的数"),
+        "min_delay": (_non_negative_number, "非负数（秒）"),
+        "default_delay": (_non_negative_number, "非负数（秒）"),
+        "max_workers": (_positive_int, "正整数"),
+    },
+    "usage": {
+        "file": (lambda v: isinstance(v, str), "字符串（为空时不保存用量）"),
+        "prices": (_prices, "模型名 -> 非负单价 的对象"),
+        "daily_budget_per_key": (_non_negative_number, "非负数（元，0表示不限制）"),
+        "key_budgets": (_key_budgets, "账号编号（\"1\"或\"2\"） -> 非负预算 的对象"),
+        "daily_budget_per_session": (_non_negative_number, "非负数（元，0表示不限制）"),
+        "retention_days": (_positive_int, "正整数（天）"),
+    },
+    "drain": {
+        "grace_period": (_non_negative_number, "非负数（秒）"),
+        "on_sigterm": (lambda v: isinstance(v, bool), "true或false"),
+    },
+}
+
+
+class CompiledConfig(NamedTuple):
+    """启动时编译一次的只读配置
+
+    字典均为只读视图，尺寸字符串、模型参数和命令前缀树预先构建，请求处理时只做查表。
+    整体替换引擎的 config 属性即可原子地切换到新配置。
+    """
+    base_url: str
+    task_base_url: str
+    models: Tuple[str, ...]
+    default_model: str
+    edit_base_url: str
+    edit_models: Tuple[str, ...]
+    default_edit_model: str
+    api_keys: MappingProxyType        # 账号编号 -> API密钥，只包含已配置的账号
+    job_deadline: float
+    progressive_preview: bool
+    ratios: MappingProxyType          # 比例 -> {"width": 宽, "height": 高}
+    default_ratio: str
+    default_negative_prompt: str
+    prompt_parser: PromptParser
+    commands: MappingProxyType        # 命令名 -> 前缀元组
+    command_trie: PrefixTrie
+    admin_users: Tuple[str, ...]      # 允许执行管理命令的会话ID
+    circuit_breaker: MappingProxyType
+    hedge: MappingProxyType
+    usage: MappingProxyType
+    drain: MappingProxyType
+
+
+def compile_config(conf: dict) -> CompiledConfig:
+    """校验配置并编译为只读结构，配置不合法时抛出ConfigError"""
+    if not conf:
+        raise ConfigError("配置未找到。")
+    qwen_config = conf.get("qwen_image", {})
+    if not qwen_config:
+        raise ConfigError("在配置中未找到qwen_image配置。")
+    qwen_edit_config = conf.get("qwen_image_edit", {})
+
+    models = _string_tuple(qwen_config.get("model", ["qwen-image", "wan2.2-t2i-flash", "wan2.2-t2i-plus"]), "qwen_image.model")
+    edit_models = _string_tuple(qwen_edit_config.get("model", ["qwen-image-edit"]), "qwen_image_edit.model")
+
+    ratios = qwen_config.get("ratios", DEFAULT_RATIOS)
+    if not isinstance(ratios, dict) or not ratios:
+        raise ConfigError("qwen_image.ratios 必须是非空的比例配置")
+    for ratio, size in ratios.items():
+        if not isinstance(size, dict) or not all(_positive_int(size.get(key)) for key in ("width", "height")):
+            raise ConfigError(f"qwen_image.ratios 中比例 {ratio} 的 width/height 必须是正整数")
+    default_ratio = qwen_config.get("default_ratio", "1:1")
+    if default_ratio not in ratios:
+        raise ConfigError(f"qwen_image.default_ratio {default_ratio} 不在 ratios 中")
+
+    job_deadline = conf.get("job_deadline", 180)
+    if not _positive_number(job_deadline):
+        raise ConfigError("job_deadline 必须是正数（秒）")
+    progressive_preview = conf.get("progressive_preview", False)
+    if not isinstance(progressive_preview, bool):
+        raise ConfigError("progressive_preview 必须是true或false")
+
+    api_keys = {}
+    for account, key in ((1, "api_key_1"), (2, "api_key_2")):
+        value = conf.get(key, "")
+        if not isinstance(value, str):
+            raise ConfigError(f"{key} 必须是字符串")
+        if value:
+            api_keys[account] = value
+
+    ratios = MappingProxyType({ratio: MappingProxyType({"width": size["width"], "height": size["height"]})
+                               for ratio, size in ratios.items()})
+    default_model = "qwen-image"  # 默认使用qwen-image模型
+    default_negative_prompt = qwen_config.get("default_negative_prompt", DEFAULT_NEGATIVE_PROMPT)
+
+    commands = {command: _string_tuple(conf.get(key, default), key) for command, key, default in COMMANDS}
+    if len(commands["admin"]) != 3:
+        raise ConfigError("admin_command 必须依次包含重新加载配置、暂停服务、恢复服务三个命令")
+    admin_users = conf.get("admin_users", [])
+    if not isinstance(admin_users, list) or not all(isinstance(user, str) and user for user in admin_users):
+        raise ConfigError("admin_users 必须是会话ID字符串列表")
+    command_trie = PrefixTrie()
+    for command, prefixes in commands.items():
+        for prefix in prefixes:
+            command_trie.add(prefix, command)
+
+    return CompiledConfig(
+        base_url=qwen_config.get("base_url", "https://dashscope.aliyuncs.com/api/v1/services/aigc/text2image/image-synthesis"),
+        task_base_url=qwen_config.get("task_base_url", "https://dashscope.aliyuncs.com/api/v1/tasks"),
+        models=models,
+        default_model=default_model,
+        edit_base_url=qwen_edit_config.get("base_url", "https://dashscope.aliyuncs.com/api/v1/services/aigc/multimodal-generation/generation"),
+        edit_models=edit_models,
+        default_edit_model="qwen-image-edit",  # 默认使用qwen-image-edit模型
+        api_keys=MappingProxyType(api_keys),
+        job_deadline=job_deadline,
+        progressive_preview=progressive_preview,
+        ratios=ratios,
+        default_ratio=default_ratio,
+        default_negative_prompt=default_negative_prompt,
+        prompt_parser=PromptParser(ratios, default_ratio, models, default_model, default_negative_prompt),
+        commands=MappingProxyType(commands),
+        command_trie=command_trie,
+        admin_users=tuple(admin_users),
+        circuit_breaker=_section(conf, "circuit_breaker"),
+        hedge=_section(conf, "hedge"),
+        usage=_section(conf, "usage"),
+        drain=_section(conf, "drain"),
+    )
+
+
+def config_property(name: str) -> property:
+    """从当前编译配置（self.config）读取的只读属性，替换 self.config 后立即生效"""
+    return property(lambda self: getattr(self.config, name))
+
+
+def _string_tuple(value, name: str) -> Tuple[str, ...]:
+    if not isinstance(value, list) or not value or not all(isinstance(item, str) and item for item in value):
+        raise ConfigError(f"{name} 必须是非空的字符串列表")
+    return tuple(value)
+
+
+def _section(conf: dict, key: str) -> MappingProxyType:
+    """按SECTION_SCHEMAS逐项校验配置段的类型和取值范围，错误信息包含完整的配置键"""
+    section = conf.get(key, {})
+    if not isinstance(section, dict):
+        raise ConfigError(f"{key} 必须是对象")
+    schema = SECTION_SCHEMAS[key]
+    for name, value in section.items():
+        if name not in schema:
+            raise ConfigError(f"{key}.{name} 不是有效的配置项，可用的配置项: {', '.join(schema)}")
+        valid, requirement = schema[name]
+        if not valid(value):
+            raise ConfigError(f"{key}.{name} 必须是{requirement}，当前为 {value!r}")
+    return MappingProxyType(dict(section))
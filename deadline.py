@@ -0,0 +1,66 @@
+import threading
+import time
+
+
+class DeadlineExceeded(Exception):
+    """任务超过了用户愿意等待的截止时间"""
+
+    def __init__(self, message: str, task_id: str = None, cancelled: bool = False, status: str = None):
+        super().__init__(message)
+        self.task_id = task_id
+        self.cancelled = cancelled  # 服务端任务是否已成功取消（未产生计算费用）
+        self.status = status  # 停止等待前最后一次查询到的任务状态，未查询到时为None
+
+
+class JobCancelled(DeadlineExceeded):
+    """任务在截止时间之前被提前结束（如同一会话发起了新的命令）"""
+
+
+class Deadline:
+    """单个任务从受理、提交、轮询到交付共用的截止时间"""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + timeout
+        self._cancel_event = threading.Event()
+        self.superseded = False  # 是否因同一会话发起了新的命令而取消
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def cancel(self, superseded: bool = True):
+        """提前结束等待：之后expired()返回True，正在sleep()的轮询立即返回
+
+        superseded为False表示任务不再需要（如最终图片先于预览完成），不计入“被新命令取代”
+        """
+        self.superseded = superseded
+        self._cancel_event.set()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def remaining(self) -> float:
+        if self.cancelled:
+            return 0.0
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.cancelled or time.monotonic() >= self.expires_at
+
+    def sleep(self, seconds: float):
+        """等待seconds秒，不超过剩余时间，被取消时立即返回"""
+        self._cancel_event.wait(min(seconds, self.remaining()))
+
+    def check(self, task_id: str = None):
+        """已取消则抛出JobCancelled，已超时则抛出DeadlineExceeded"""
+        if self.cancelled:
+            raise JobCancelled("任务已被新的命令取代" if self.superseded else "任务已不再需要，提前结束", task_id=task_id)
+        if self.expired():
+            raise DeadlineExceeded(f"任务超过{self.timeout:.0f}秒的等待时间", task_id=task_id)
+
+    def request_timeout(self, cap: float) -> float:
+        """单次HTTP请求的超时时间：不超过cap，也不超过剩余时间"""
+        self.check()
+        return min(cap, self.remaining())
@@ -0,0 +1,804 @@
+import os
+import json
+import contextvars
+import logging
+import requests
+import time
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Tuple
+from io import BytesIO
+
+from .admission import AdmissionGate
+from .circuit_breaker import BreakerRegistry, CircuitOpenError
+from .compiled_config import CompiledConfig, compile_config, config_property
+from .deadline import Deadline, DeadlineExceeded, JobCancelled
+from .structured_log import logger, slog, submit_in_context
+from .usage_meter import BudgetExceededError, Reservation, UsageMeter
+
+
+class TaskFailedError(Exception):
+    """服务端已结束的任务没有产出图片（如内容审核未通过），重试轮询不会改变结果"""
+
+    def __init__(self, message: str, task_id: str = None, status: str = None, error_code: str = None, error_message: str = None):
+        super().__init__(message)
+        self.task_id = task_id
+        self.status = status
+        self.error_code = error_code
+        self.error_message = error_message
+
+
+def load_config_file(path: str = None) -> dict:
+    """读取插件配置文件，默认读取插件目录下的config.json"""
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class QwenImageEngine:
+    """不依赖机器人框架的生成引擎：配置、参数解析、文生图、图生图以及账号熔断/对冲
+
+    插件和批量CLI共用此引擎
+    """
+
+    base_url = config_property("base_url")
+    task_base_url = config_property("task_base_url")  # 异步任务查询/取消接口
+    models = config_property("models")
+    default_model = config_property("default_model")
+    edit_base_url = config_property("edit_base_url")
+    edit_models = config_property("edit_models")
+    default_edit_model = config_property("default_edit_model")
+    # 账号池（账号编号 -> API密钥），当前账号熔断时自动路由到其他账号，也用于对冲提交
+    api_keys = config_property("api_keys")
+    # 任务截止时间（秒），从受理开始，覆盖提交、轮询和交付全过程
+    job_deadline = config_property("job_deadline")
+    ratios = config_property("ratios")
+    default_ratio = config_property("default_ratio")
+    default_negative_prompt = config_property("default_negative_prompt")
+    # 参数解析器：尺寸字符串和模型参数在编译配置时预先计算
+    prompt_parser = config_property("prompt_parser")
+
+    # 对冲提交配置：提交耗时超过历史延迟分位数时，在另一个健康账号上重新提交
+    hedge_enabled = property(lambda self: self.config.hedge.get("enabled", True))
+    hedge_percentile = property(lambda self: self.config.hedge.get("percentile", 95))
+    hedge_min_delay = property(lambda self: self.config.hedge.get("min_delay", 1))
+    hedge_default_delay = property(lambda self: self.config.hedge.get("default_delay", 5))
+
+    @property
+    def api_key_1(self) -> str:
+        return self.config.api_keys.get(1, "")
+
+    @property
+    def api_key_2(self) -> str:
+        return self.config.api_keys.get(2, "")
+
+    def __init__(self, conf: dict):
+        # 校验并编译配置：比例尺寸、模型参数和命令前缀在此一次性构建为只读结构
+        self.config = compile_config(conf)
+        
+        self.current_api_key = self.api_key_1  # 默认使用第一个API密钥
+        self.current_account = 1  # 当前使用的账号编号
+        # 是否在账号池内按进行中的任务数均衡分配（批量CLI使用），否则优先当前账号
+        self.balance_keys = False
+        self._key_in_flight = {account: 0 for account in self.api_keys}
+        
+        # 熔断配置：按账号和接口地址分别统计滚动窗口内的错误率和延迟
+        breaker_settings = self._breaker_settings(self.config)
+        self.key_breakers = BreakerRegistry(**breaker_settings)
+        self.endpoint_breakers = BreakerRegistry(**breaker_settings)
+        
+        # 对冲提交线程池，线程数只在启动时读取
+        max_workers = self.config.hedge.get("max_workers", 8)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="QwenImage")
+        
+        # HTTP连接池：提交、轮询和取消复用TLS连接，轮询不再每次重新握手
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(10, max_workers * 2))
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        
+        # 用户状态管理（用于存储每个用户的智能扩写设置）
+        self.user_prompt_extend_settings = {}  # 用户ID -> 智能扩写设置
+        self.global_prompt_extend = True  # 全局默认智能扩写设置
+        
+        # 渐进模式（先交付快速预览，再交付最终图片）：按会话开启，默认值来自配置
+        self.user_preview_settings = {}  # 用户ID -> 是否开启快速预览
+        
+        # 任务统计（超时、取消以及因此避免的算力浪费）
+        self.job_stats = {
+            "submitted": 0,           # 已提交的异步任务数
+            "succeeded": 0,           # 成功完成的异步任务数
+            "render_seconds": 0.0,    # 成功任务的累计耗时，用于估算单任务算力
+            "deadline_exceeded": 0,   # 超过截止时间的任务数
+            "cancelled": 0,           # 超时后成功取消的排队任务数（未产生费用）
+            "cancel_failed": 0,       # 超时后取消失败的任务数
+            "expired_running": 0,     # 超时时已在运行、无法取消的任务数
+            "circuit_rejected": 0,    # 因熔断被快速拒绝的请求数
+            "hedged": 0,              # 触发对冲提交的次数
+            "hedge_won": 0,           # 对冲请求先于首选请求成功的次数
+            "hedge_cancelled": 0,     # 落败后被取消的重复任务数
+            "superseded": 0,          # 被同一会话的新命令取代而停止的任务数
+            "previews": 0,            # 渐进模式下已交付的快速预览数
+            "previews_dropped": 0,    # 最终图片先完成而停止的预览任务数
+            "first_images": 0,        # 已交付首张图片（预览或最终图片）的绘图命令数
+            "first_image_seconds": 0.0,  # 从受理到首张图片交付的累计耗时
+        }
+        self._stats_lock = threading.Lock()
+        
+        # 用量计费：按账号、模型、会话统计每日出图数和估算费用，账号预算用完后路由到其他账号
+        self.usage = UsageMeter.from_config(self.config.usage, os.path.dirname(os.path.abspath(__file__)))
+        
+        # 受理闸门：排空时拒绝新任务，等待进行中的任务完成
+        self.admission = AdmissionGate()
+
+    def reload_config(self, conf: dict) -> CompiledConfig:
+        """重新加载配置：校验通过后原子替换编译配置，配置不合法时抛出ConfigError并保留原配置
+
+        线程池、连接池、熔断状态、任务统计和用量记录保持不变，进行中的任务继续使用提交时的账号轮询。
+        """
+        config = compile_config(conf)
+        # 先构建所有派生设置，任何一步失败都不会留下只生效了一半的配置
+        breaker_settings = self._breaker_settings(config)
+        usage_limits = UsageMeter.limits_from_config(config.usage)
+        current_account = self.current_account
+        if current_account not in config.api_keys:
+            # 当前账号的密钥已被移除，切换到第一个已配置的账号
+            current_account = next(iter(config.api_keys), 1)
+
+        self.config = config
+        self.current_account = current_account
+        self.current_api_key = config.api_keys.get(current_account, "")
+        self.key_breakers.configure(**breaker_settings)
+        self.endpoint_breakers.configure(**breaker_settings)
+        self.usage.set_limits(**usage_limits)
+        slog.info("配置已重新加载", models=list(config.models), ratios=list(config.ratios), accounts=list(config.api_keys), account=self.current_account)
+        return config
+
+    @staticmethod
+    def _breaker_settings(config: CompiledConfig) -> dict:
+        return {k: config.circuit_breaker[k] for k in ("window", "min_calls", "error_rate", "slow_call_seconds", "cooldown") if k in config.circuit_breaker}
+
+    def get_session_id(self, context):
+        """获取会话ID，兼容不同的Context对象结构"""
+        try:
+            # 尝试从字典方式获取session_id
+            if hasattr(context, '__getitem__'):
+                return context.get("session_id", "default_user")
+            # 尝试从属性方式获取session_id
+            elif hasattr(context, 'session_id'):
+                return context.session_id
+            # 尝试从from_user_id获取
+            elif hasattr(context, '__getitem__') and context.get("from_user_id"):
+                return context.get("from_user_id")
+            else:
+                return "default_user"
+        except Exception as e:
+            logger.warning(f"[QwenImage] 获取session_id失败: {e}，使用默认值")
+            return "default_user"
+
+    def parse_user_input(self, content: str, context) -> Tuple[str, str, str, bool, str]:
+        """解析用户输入，提取提示词、图片尺寸、模型、智能改写设置和负面提示词"""
+        # 一次调用解析所有参数（尺寸、模型、负面提示词）并清理提示词
+        clean_prompt, image_size, model, negative_prompt = self.prompt_parser.parse(content)
+        
+        # 获取用户的智能改写设置
+        session_id = self.get_session_id(context)
+        prompt_extend = self.get_user_prompt_extend_setting(session_id)
+        
+        slog.debug("解析用户输入", size=image_size, model=model, prompt_extend=prompt_extend, negative_prompt=negative_prompt, prompt=clean_prompt)
+        return clean_prompt, image_size, model, prompt_extend, negative_prompt
+
+    def get_user_prompt_extend_setting(self, session_id: str) -> bool:
+        """获取用户的智能改写设置"""
+        if session_id in self.user_prompt_extend_settings:
+            return self.user_prompt_extend_settings[session_id]
+        else:
+            return self.global_prompt_extend  # 返回全局默认设置
+
+    def get_user_preview_setting(self, session_id: str) -> bool:
+        """获取用户的快速预览设置"""
+        return self.user_preview_settings.get(session_id, self.config.progressive_preview)
+
+    def extract_image_size(self, prompt: str) -> str:
+        """提取图片尺寸参数"""
+        return self.prompt_parser.image_size(prompt)
+
+    def extract_model(self, prompt: str) -> str:
+        """提取模型参数，--flash优先于--plus，默认使用qwen-image模型"""
+        return self.prompt_parser.model(prompt)
+
+    def clean_prompt_string(self, prompt: str) -> str:
+        """清理提示词，移除所有参数"""
+        return self.prompt_parser.clean_prompt(prompt)
+
+    def extract_negative_prompt(self, prompt: str) -> str:
+        """从用户提示词中提取负面提示词，未指定时使用默认的负面提示词"""
+        return self.prompt_parser.negative_prompt(prompt)
+
+    def extract_ratio_from_prompt(self, prompt: str) -> str:
+        """从用户提示词中直接提取比例信息"""
+        return self.prompt_parser.ratio(prompt)
+
+    def generate_image(self, prompt: str, image_size: str, model: str, prompt_extend: bool, negative_prompt: str, deadline: Deadline = None, on_submitted=None, session_id: str = None) -> str:
+        """调用Qwen Image API生成图片
+        Args:
+            deadline: 任务截止时间，未传入时从调用时刻开始按job_deadline计算
+            on_submitted: 任务提交成功后的回调 on_submitted(task_id, account)，用于记录断点
+            session_id: 发起请求的会话，用于会话用量统计和每日预算
+        """
+        if deadline is None:
+            deadline = Deadline(self.job_deadline)
+        # 预占会话额度和账号预算，出图后随记账结算，失败或取消时在finally中释放
+        reservation = self.usage.reserve(session_id, self.usage.estimate(model))
+        slog.info("准备调用Qwen Image API生成图片", model=model, size=image_size, prompt_extend=prompt_extend, negative_prompt=negative_prompt, account=self.current_account)
+
+        # 构建请求体
+        payload = {
+            "model": model,
+            "input": {
+                "prompt": prompt,
+                "negative_prompt": negative_prompt
+            },
+            "parameters": {
+                "size": image_size.replace('x', '*'),  # 将1024x1024转换为1024*1024
+                "n": 1,
+                "watermark": False,
+                "prompt_extend": prompt_extend
+            }
+        }
+
+        slog.debug("发送请求体", payload=payload)
+        slog.info("使用API URL", url=self.base_url)
+
+        try:
+            # 提交任务（熔断路由 + 对冲提交），轮询使用提交任务的同一个密钥
+            task_id, account, api_key = self._submit_task(payload, deadline, reservation)
+            
+            slog.info("✅ 任务提交成功", task_id=task_id, account=account)
+            self._incr_stat("submitted")
+            if on_submitted:
+                on_submitted(task_id, account)
+            
+            # 轮询任务结果
+            return self._track_in_flight(account, self._poll_task_result, task_id, api_key=api_key, deadline=deadline,
+                                         meter=(account, model, session_id), reservation=reservation)
+            
+        except requests.exceptions.RequestException as e:
+            if deadline.cancelled:
+                self._incr_cancelled_stat(deadline)
+                raise JobCancelled("任务已被新的命令取代" if deadline.superseded else "任务已不再需要，提前结束")
+            if deadline.expired():
+                # 提交阶段超时：服务端是否已创建任务未知，无法取消
+                self._incr_stat("deadline_exceeded")
+                raise DeadlineExceeded(f"提交任务超过{deadline.timeout:.0f}秒的等待时间")
+            if hasattr(e, 'response') and e.response is not None:
+                slog.error("API请求失败", error=e, status=e.response.status_code, body=e.response.text)
+            else:
+                slog.error("API请求失败", error=e)
+            raise Exception(f"API请求失败: {str(e)}")
+        except JobCancelled:
+            self._incr_cancelled_stat(deadline)
+            raise
+        except DeadlineExceeded:
+            self._incr_stat("deadline_exceeded")
+            raise
+        finally:
+            reservation.release()
+
+    def generate_image_progressive(self, prompt: str, image_size: str, model: str, prompt_extend: bool, negative_prompt: str, on_preview, deadline: Deadline = None, session_id: str = None) -> str:
+        """渐进式生成：同时向快速（flash）模型和请求的模型提交同一提示词，
+        预览图完成后立即通过 on_preview(url) 交付，返回最终图片URL
+
+        预览失败不影响最终图片；最终图片先完成时停止预览任务（排队中的预览任务在服务端取消），
+        不再交付预览。最终任务被取消（deadline.cancel()）时，预览照常交付并计入用量。
+        预览在后台线程中运行，计入受理闸门的进行中任务，排空时会等待预览结束。
+        """
+        if deadline is None:
+            deadline = Deadline(self.job_deadline)
+        preview_model = self.prompt_parser.flash_model
+        # 预览使用独立的截止时间，最终任务被新命令取代时预览仍然交付
+        preview_deadline = Deadline(deadline.remaining())
+        delivery_lock = threading.Lock()
+        final_done = False
+
+        def run_preview():
+            try:
+                preview_url = self.generate_image(prompt, image_size, preview_model, prompt_extend, negative_prompt,
+                                                  deadline=preview_deadline, session_id=session_id)
+                with delivery_lock:
+                    if final_done:
+                        slog.info("最终图片先于预览完成，不再交付预览", model=preview_model)
+                        return
+                    on_preview(preview_url)
+                    self._incr_stat("previews")
+            except JobCancelled as e:
+                slog.info("最终图片先于预览完成，已停止预览任务", model=preview_model, cancelled=e.cancelled)
+            except Exception as e:
+                slog.warning("快速预览生成失败，继续等待最终图片", model=preview_model, error=e)
+            finally:
+                # 交付完成后才结束，排空期间不会在发送预览图时更新插件
+                self.admission.finish()
+
+        # 预览是已受理任务的一部分：排空期间也不拒绝，但计入进行中的任务，在启动线程前计入避免漏计
+        self.admission.begin(check_draining=False)
+        try:
+            # 预览线程保留当前请求的关联ID
+            threading.Thread(target=contextvars.copy_context().run, args=(run_preview,), daemon=True).start()
+        except Exception:
+            self.admission.finish()
+            raise
+        image_url = self.generate_image(prompt, image_size, model, prompt_extend, negative_prompt,
+                                        deadline=deadline, session_id=session_id)
+        # 只有最终图片成功时才停止预览；最终任务失败或被取代时预览照常交付
+        with delivery_lock:
+            final_done = True
+            preview_deadline.cancel(superseded=False)
+        return image_url
+
+    def resume_task(self, task_id: str, account: int, deadline: Deadline = None, model: str = None, session_id: str = None) -> str:
+        """继续轮询已提交的任务（如批量CLI中断后恢复），不会重新提交"""
+        if account not in self.api_keys:
+            raise Exception(f"账号 {account} 未配置API密钥，无法继续查询任务 {task_id}")
+        if deadline is None:
+            deadline = Deadline(self.job_deadline)
+        try:
+            return self._track_in_flight(account, self._poll_task_result, task_id, api_key=self.api_keys[account], deadline=deadline,
+                                         meter=(account, model or self.default_model, session_id))
+        except DeadlineExceeded:
+            self._incr_stat("deadline_exceeded")
+            raise
+
+    def _track_in_flight(self, account: int, func, *args, **kwargs):
+        """统计各账号进行中的任务数，供均衡分配账号使用"""
+        with self._stats_lock:
+            self._key_in_flight[account] = self._key_in_flight.get(account, 0) + 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self._key_in_flight[account] -= 1
+
+    def _submit_task(self, payload: dict, deadline: Deadline, reservation: Reservation = None) -> Tuple[str, int, str]:
+        """提交异步任务，返回(任务ID, 提交所用的账号编号, API密钥)
+        首选账号的提交耗时超过历史延迟分位数时，在另一个健康账号上对冲提交，
+        先成功者胜出，落败的请求拿到任务ID后立即取消该任务并释放其账号预算的预占。
+        """
+        endpoint = self.endpoint_breakers.get(self.base_url)
+        if not endpoint.allow():
+            self._incr_stat("circuit_rejected")
+            raise CircuitOpenError(f"接口 {self.base_url} 暂时不可用，请稍后重试")
+        account, api_key = self._select_api_key(reservation=reservation)
+        primary = submit_in_context(self._executor, self._post_submit, self.base_url, account, api_key, payload, deadline)
+        futures = {primary: (account, api_key)}
+
+        done, _ = wait([primary], timeout=min(self._hedge_delay(endpoint), deadline.remaining()))
+        if not done and self.hedge_enabled:
+            try:
+                hedge_account, hedge_key = self._select_api_key(exclude=(account,), reservation=reservation)
+            except (CircuitOpenError, BudgetExceededError):
+                hedge_account = None
+            if hedge_account is not None:
+                slog.info("提交耗时过长，使用另一个账号对冲提交", account=account, hedge_account=hedge_account)
+                self._incr_stat("hedged")
+                futures[submit_in_context(self._executor, self._post_submit, self.base_url, hedge_account, hedge_key, payload, deadline)] = (hedge_account, hedge_key)
+
+        error = None
+        outstanding = set(futures)
+        while outstanding and not deadline.expired():
+            done, outstanding = wait(outstanding, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                # 首个成功者胜出，其余请求返回任务ID后立即取消
+                for loser in (outstanding | done) - {future}:
+                    self._cancel_when_submitted(loser, futures[loser][1])
+                    if reservation is not None:
+                        reservation.release_key(futures[loser][0])
+                if future is not primary:
+                    self._incr_stat("hedge_won")
+                return (future.result(),) + futures[future]
+
+        for loser in outstanding:
+            self._cancel_when_submitted(loser, futures[loser][1])
+        if error is not None:
+            raise error
+        if deadline.cancelled:
+            raise JobCancelled("任务已被新的命令取代" if deadline.superseded else "任务已不再需要，提前结束")
+        raise DeadlineExceeded(f"提交任务超过{deadline.timeout:.0f}秒的等待时间")
+
+    def _post_submit(self, url: str, account: int, api_key: str, payload: dict, deadline: Deadline) -> str:
+        """使用指定账号提交一次异步任务，记录熔断统计，返回任务ID"""
+        headers = {
+            "X-DashScope-Async": "enable",
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        started = time.monotonic()
+        try:
+            response = self.http.post(url, headers=headers, json=payload, timeout=deadline.request_timeout(180))
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self._record_call(url, account, e, time.monotonic() - started)
+            raise
+        self._record_call(url, account, None, time.monotonic() - started)
+        
+        # 获取任务ID
+        task_id = response.json().get("output", {}).get("task_id")
+        if not task_id:
+            slog.error("❌ 未获取到任务ID", account=account)
+            raise Exception("API响应中未获取到任务ID")
+        return task_id
+
+    def _cancel_when_submitted(self, future, api_key: str):
+        """对冲落败的提交请求返回任务ID后取消该任务，避免重复计费"""
+        def cancel(f):
+            if f.cancelled() or f.exception() is not None:
+                return
+            if self._cancel_task(f.result(), api_key):
+                self._incr_stat("hedge_cancelled")
+        # 回调在工作线程中执行，保留当前请求的关联ID
+        context = contextvars.copy_context()
+        future.add_done_callback(lambda f: context.run(cancel, f))
+
+    def _select_api_key(self, exclude=(), reservation: Reservation = None) -> Tuple[int, str]:
+        """选择可用账号，优先当前账号（balance_keys时优先进行中任务最少的账号），
+        首选账号熔断或今日剩余预算不足以支付本次费用时路由到其他账号；
+        传入reservation时在选定的账号上预占本次费用"""
+        if not self.api_keys:
+            logger.error("[QwenImage] 未配置Qwen API Key")
+            raise Exception("未配置API Key")
+        candidates = [self.current_account] + [account for account in self.api_keys if account != self.current_account]
+        if self.balance_keys:
+            with self._stats_lock:
+                candidates = sorted(self.api_keys, key=lambda account: self._key_in_flight.get(account, 0))
+        over_budget = False
+        for account in candidates:
+            if account in exclude or account not in self.api_keys:
+                continue
+            if reservation is not None and not reservation.reserve_key(account):
+                over_budget = True
+                continue
+            if not self.key_breakers.get(account).allow():
+                if reservation is not None:
+                    reservation.release_key(account)
+                continue
+            if account != self.current_account and not exclude and not self.balance_keys:
+                slog.sampled(logging.WARNING, f"route:{self.current_account}->{account}", 10, "当前账号不可用，路由到其他账号", account=self.current_account, routed_to=account)
+            return account, self.api_keys[account]
+        if over_budget:
+            raise BudgetExceededError("所有API账号今日预算已用完，请明天再试")
+        if not exclude:
+            self._incr_stat("circuit_rejected")
+        raise CircuitOpenError("所有API账号暂时不可用，请稍后重试")
+
+    def _hedge_delay(self, endpoint) -> float:
+        """对冲等待时间：接口近期提交延迟的分位数，样本不足时使用默认值"""
+        delay = endpoint.latency_percentile(self.hedge_percentile)
+        if delay is None:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, delay)
+
+    def _record_call(self, url: str, account: int, error, latency: float = None):
+        """记录一次请求结果到接口和账号熔断器；客户端错误（如参数错误）不计为故障"""
+        response = getattr(error, "response", None)
+        if error is None:
+            endpoint_ok = key_ok = True
+        elif response is None:
+            # 超时、连接失败
+            endpoint_ok = key_ok = False
+        else:
+            endpoint_ok = response.status_code < 500
+            key_ok = endpoint_ok and response.status_code not in (401, 403, 429)
+        self.endpoint_breakers.get(url).record(endpoint_ok, latency)
+        self.key_breakers.get(account).record(key_ok, latency)
+
+    def _poll_task_result(self, task_id: str, max_retries: int = 60, retry_interval: int = 2, api_key: str = None, deadline: Deadline = None, meter: tuple = None, reservation: Reservation = None) -> str:
+        """轮询任务结果，获取生成的图像URL；只有请求失败和PENDING/RUNNING会继续轮询，
+        任务已结束但没有图片（FAILED等）时立即抛出TaskFailedError
+        Args:
+            max_retries: 未传入deadline时，按 max_retries * retry_interval 秒作为截止时间
+            api_key: 提交任务时使用的密钥，默认使用当前密钥
+            deadline: 任务截止时间，超时后取消仍在排队的任务
+            meter: (账号编号, 模型, 会话ID)，任务成功后按响应中的usage记录用量
+            reservation: 任务预占的预算，记录用量时一并结算
+        """
+        if deadline is None:
+            deadline = Deadline(max_retries * retry_interval)
+        api_key = api_key or self.current_api_key
+        poll_url = f"{self.task_base_url}/{task_id}"
+        headers = {
+            "Authorization": f"Bearer {api_key}"
+        }
+        
+        task_status = None
+        attempt = 0
+        while not deadline.expired():
+            try:
+                response = self.http.get(poll_url, headers=headers, timeout=deadline.request_timeout(30))
+                response.raise_for_status()
+                result_data = response.json()
+                
+                task_status = result_data.get("output", {}).get("task_status")
+                
+                if task_status == "SUCCEEDED":
+                    # 任务成功，获取结果图像
+                    results = result_data.get("output", {}).get("results", [])
+                    if results and len(results) > 0:
+                        image_url = results[0].get("url")
+                        if image_url:
+                            slog.info("✅ 任务成功，获取到图像URL", task_id=task_id, attempts=attempt + 1, url=image_url)
+                            self._incr_stat("succeeded")
+                            self._incr_stat("render_seconds", deadline.elapsed())
+                            if meter:
+                                self._meter_usage(*meter, result_data.get("usage"), reservation=reservation)
+                            return image_url
+                        else:
+                            slog.error("❌ 图像URL为空", task_id=task_id)
+                            raise TaskFailedError("图像URL为空", task_id=task_id, status=task_status)
+                    else:
+                        slog.error("❌ 没有获取到结果", task_id=task_id)
+                        raise TaskFailedError("没有获取到结果", task_id=task_id, status=task_status)
+                
+                elif task_status in ["FAILED", "CANCELED", "UNKNOWN"]:
+                    # 任务已结束（失败、被取消或已过期），继续轮询不会改变结果
+                    error_code = result_data.get("output", {}).get("error_code", "未知")
+                    error_message = result_data.get("output", {}).get("error_message", "未知")
+                    slog.error("❌ 任务执行失败", task_id=task_id, status=task_status, error_code=error_code, error_message=error_message)
+                    raise TaskFailedError(f"任务执行失败: {error_code} - {error_message}", task_id=task_id, status=task_status,
+                                          error_code=error_code, error_message=error_message)
+                
+                elif task_status in ["PENDING", "RUNNING"]:
+                    # 任务还在进行中，等待后重试
+                    if attempt % 10 == 0:  # 每10次重试打印一次状态
+                        slog.info("⏳ 任务进行中", task_id=task_id, status=task_status, attempt=attempt + 1)
+                    deadline.sleep(retry_interval)
+                    continue
+                
+                else:
+                    slog.sampled(logging.WARNING, "poll_status", 10, "⚠️ 未知任务状态", task_id=task_id, status=task_status)
+                    deadline.sleep(retry_interval)
+                    continue
+                    
+            except DeadlineExceeded:
+                break
+            except TaskFailedError:
+                raise
+            except requests.exceptions.RequestException as e:
+                slog.sampled(logging.ERROR, "poll_error", 10, "❌ 轮询请求失败", task_id=task_id, error=e)
+                deadline.sleep(retry_interval)
+                continue
+            except Exception as e:
+                # 响应不是合法的JSON等暂时性问题，继续轮询
+                slog.sampled(logging.ERROR, "poll_error", 10, "❌ 轮询处理失败", task_id=task_id, error=e)
+                deadline.sleep(retry_interval)
+                continue
+            finally:
+                attempt += 1
+        
+        reason = "任务已被新的命令取代" if deadline.superseded else "任务已不再需要"
+        if deadline.cancelled:
+            slog.info(f"{reason}，停止轮询", task_id=task_id, status=task_status, attempts=attempt)
+        else:
+            slog.error("❌ 轮询超时", task_id=task_id, status=task_status, attempts=attempt)
+        cancelled = False
+        # 提前结束的任务只计入superseded/previews_dropped，不计入超时相关统计
+        if task_status == "PENDING":
+            # 排队中的任务可以取消，避免继续占用算力和产生费用
+            cancelled = self._cancel_task(task_id, api_key)
+            if not deadline.cancelled:
+                self._incr_stat("cancelled" if cancelled else "cancel_failed")
+        elif task_status == "RUNNING" and not deadline.cancelled:
+            # DashScope只支持取消排队中的任务，运行中的任务会继续执行直至完成
+            self._incr_stat("expired_running")
+        if deadline.cancelled:
+            raise JobCancelled(f"{reason}：{task_id}", task_id=task_id, cancelled=cancelled, status=task_status)
+        raise DeadlineExceeded(f"任务 {task_id} 超过{deadline.timeout:.0f}秒的等待时间", task_id=task_id, cancelled=cancelled, status=task_status)
+
+    def _cancel_task(self, task_id: str, api_key: str) -> bool:
+        """取消排队中（PENDING）的异步任务，返回是否取消成功"""
+        cancel_url = f"{self.task_base_url}/{task_id}/cancel"
+        headers = {
+            "Authorization": f"Bearer {api_key}"
+        }
+        try:
+            response = self.http.post(cancel_url, headers=headers, timeout=10)
+            response.raise_for_status()
+            slog.info("已取消任务", task_id=task_id)
+            return True
+        except requests.exceptions.RequestException as e:
+            slog.warning("取消任务失败", task_id=task_id, error=e)
+            return False
+
+    def _meter_usage(self, account: int, model: str, session_id: str, usage: dict, reservation: Reservation = None):
+        """按API响应中的usage.image_count记录用量并结算预占，响应缺少usage时按1张计
+
+        记账只是尽力而为：任何失败都只记录日志，已经生成（已付费）的图片照常交付。
+        """
+        images = (usage or {}).get("image_count") or 1
+        try:
+            self.usage.record(account, model, session_id, images, reservation=reservation)
+        except Exception as e:
+            slog.error("记录用量失败，图片照常交付", account=account, model=model, session=session_id, error=e)
+            if reservation is not None:
+                reservation.release()
+
+    def _incr_cancelled_stat(self, deadline: Deadline):
+        """提前结束的任务：被新命令取代，或最终图片先完成而停止的预览"""
+        self._incr_stat("superseded" if deadline.superseded else "previews_dropped")
+
+    def _incr_stat(self, name: str, value=1):
+        """线程安全地累加任务统计"""
+        with self._stats_lock:
+            self.job_stats[name] += value
+
+    def edit_image(self, image_content, edit_prompt, deadline: Deadline = None, session_id: str = None):
+        """调用Qwen Image Edit API编辑图片
+        Args:
+            image_content: 可以是文件路径(str)或图片二进制数据(bytes)
+            edit_prompt: 编辑指令
+            deadline: 任务截止时间，未传入时从调用时刻开始按job_deadline计算
+            session_id: 发起请求的会话，用于会话用量统计和每日预算
+        """
+        if deadline is None:
+            deadline = Deadline(self.job_deadline)
+        cost = self.usage.estimate(self.default_edit_model)
+        # 额度不足时在转换图片之前就拒绝
+        self.usage.check_session_budget(session_id, cost)
+        slog.info("准备调用Qwen Image Edit API编辑图片", model=self.default_edit_model, prompt=edit_prompt)
+
+        if not self.api_keys:
+            logger.error("[QwenImage] 未配置Qwen API Key")
+            raise Exception("未配置API Key")
+
+        try:
+            # 将图片内容转换为base64格式
+            image_base64 = self._process_image_to_base64(image_content)
+            slog.debug("📷 图片已转换为base64格式", length=len(image_base64))
+        except Exception as e:
+            slog.error("❌ 图片转base64失败", error=e)
+            raise Exception(f"图片转base64失败 - {e}")
+
+        # 构造API请求，参考ComfyUI节点的实现
+        payload = {
+            "model": self.default_edit_model,
+            "input": {
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "image": image_base64
+                            },
+                            {
+                                "text": edit_prompt
+                            }
+                        ]
+                    }
+                ]
+            },
+            "parameters": {
+                "negative_prompt": self.default_negative_prompt,
+                "prompt_extend": True,
+                "watermark": False
+            }
+        }
+
+        # 预占会话额度和账号预算，编辑成功后随记账结算，失败时在finally中释放
+        reservation = self.usage.reserve(session_id, cost)
+        try:
+            # 图像编辑接口是同步接口，整个生成过程都在一次请求内，不做对冲以免重复计费
+            if not self.endpoint_breakers.get(self.edit_base_url).allow():
+                self._incr_stat("circuit_rejected")
+                raise CircuitOpenError(f"接口 {self.edit_base_url} 暂时不可用，请稍后重试")
+            account, api_key = self._select_api_key(reservation=reservation)
+
+            headers = {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json"
+            }
+
+            slog.debug("发送请求体", payload=payload)
+            slog.info("使用API URL", url=self.edit_base_url, account=account)
+
+            # 发送请求
+            slog.debug("🚀 发送API请求")
+            # 超时后只能放弃等待，无法取消服务端计算
+            try:
+                response = self._track_in_flight(account, self.http.post, self.edit_base_url, headers=headers, json=payload, timeout=deadline.request_timeout(180))
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                self._record_call(self.edit_base_url, account, e)
+                raise
+            self._record_call(self.edit_base_url, account, None)
+            
+            result_data = response.json()
+            slog.info("✅ API请求成功", elapsed=lambda: f"{deadline.elapsed():.1f}s")
+            
+            # 解析响应，参考ComfyUI节点的实现
+            choices = result_data.get("output", {}).get("choices", [])
+            if choices and len(choices) > 0:
+                content = choices[0].get("message", {}).get("content", [])
+                
+                # 查找图像内容
+                image_content = None
+                for item in content:
+                    if "image" in item:
+                        image_content = item["image"]
+                        break
+                
+                if image_content:
+                    slog.info("🖼️ 获取到编辑结果", url=image_content)
+                    self._meter_usage(account, self.default_edit_model, session_id, result_data.get("usage"), reservation=reservation)
+                    return image_content
+                else:
+                    slog.error("❌ 响应中未找到图像内容")
+                    raise Exception("响应中未找到图像内容")
+            else:
+                slog.error("❌ 响应格式异常", response=result_data)
+                raise Exception("响应格式异常")
+                
+        except DeadlineExceeded:
+            self._incr_stat("deadline_exceeded")
+            raise
+        except requests.exceptions.RequestException as e:
+            if deadline.expired():
+                self._incr_stat("deadline_exceeded")
+                raise DeadlineExceeded(f"图像编辑超过{deadline.timeout:.0f}秒的等待时间")
+            if hasattr(e, 'response') and e.response is not None:
+                slog.error("❌ API请求失败", error=e, status=e.response.status_code, body=e.response.text)
+            else:
+                slog.error("❌ API请求失败", error=e)
+            raise Exception(f"API请求失败: {str(e)}")
+        finally:
+            reservation.release()
+
+    def _process_image_to_base64(self, image_content):
+        """将图像内容转换为base64格式"""
+        try:
+            # 如果image_content是文件路径，直接读取文件
+            if isinstance(image_content, str) and os.path.exists(image_content):
+                with open(image_content, 'rb') as image_file:
+                    image_data = image_file.read()
+            # 如果image_content是URL，下载图片
+            elif isinstance(image_content, str) and (image_content.startswith('http://') or image_content.startswith('https://')):
+                response = self.http.get(image_content, timeout=60)
+                response.raise_for_status()
+                image_data = response.content
+            # 如果image_content是bytes数据
+            elif isinstance(image_content, bytes):
+                image_data = image_content
+            else:
+                # 尝试处理其他格式
+                logger.warning(f"[QwenImage] 未知的图像内容格式: {type(image_content)}")
+                # 如果是字符串，假设是base64编码的图片数据
+                if isinstance(image_content, str):
+                    try:
+                        image_data = base64.b64decode(image_content)
+                    except:
+                        raise Exception(f"无法处理的图像内容格式: {type(image_content)}")
+                else:
+                    raise Exception(f"无法处理的图像内容格式: {type(image_content)}")
+            
+            # 验证图片格式并转换为JPEG；PIL只在首次改图时导入，不拖慢插件启动
+            from PIL import Image
+            img = Image.open(BytesIO(image_data))
+            
+            # 确保是RGB格式
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            
+            # 保存为JPEG格式并转换为base64
+            output_buffer = BytesIO()
+            img.save(output_buffer, format="JPEG", quality=95)
+            image_data_bytes_jpeg = output_buffer.getvalue()
+            image_base64 = base64.b64encode(image_data_bytes_jpeg).decode('utf-8')
+            
+            return f"data:image/jpeg;base64,{image_base64}"
+            
+        except Exception as e:
+            logger.error(f"[QwenImage] 图像转换失败: {e}")
+            raise
+
@@ -0,0 +1,139 @@
+import contextvars
+import logging
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+
+try:
+    from common.log import logger
+except ImportError:
+    # 脱离机器人框架运行（如批量CLI）时使用标准logging
+    logger = logging.getLogger("QwenImage")
+
+# 单个字段的最大长度，超出部分截断
+MAX_FIELD_LENGTH = 200
+# 不截断的字段：结果图片的签名URL通常超过200字，完整记录才能从日志中取回已交付的图片
+_UNTRUNCATED_FIELDS = ("url",)
+
+_BASE64_PATTERN = re.compile(r'data:[\w/+.-]+;base64,[A-Za-z0-9+/=]*')
+_API_KEY_PATTERN = re.compile(r'sk-[A-Za-z0-9]{4,}')
+_SECRET_FIELDS = ("authorization", "api_key", "api_key_1", "api_key_2")
+
+_request_id = contextvars.ContextVar("qwen_image_request_id", default=None)
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:8]
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+@contextmanager
+def request_context(request_id: str = None):
+    """为一次请求设置关联ID，提交、轮询和交付日志都会带上同一个ID"""
+    token = _request_id.set(request_id or new_request_id())
+    try:
+        yield _request_id.get()
+    finally:
+        _request_id.reset(token)
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """在线程池中执行时保留当前请求的关联ID"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def mask_secret(value: str) -> str:
+    """密钥只保留末4位"""
+    return f"****{value[-4:]}" if len(value) > 8 else "****"
+
+
+def redact(value, max_length: int = MAX_FIELD_LENGTH):
+    """递归脱敏：base64图片替换为长度摘要，API密钥打码，超长字符串截断（max_length为None时不截断）；
+    数字、布尔值和None以外的对象先转为字符串。字典中的url字段不截断"""
+    if isinstance(value, dict):
+        return {k: mask_secret(str(v)) if str(k).lower() in _SECRET_FIELDS else redact(v, _field_max_length(k, max_length))
+                for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v, max_length) for v in value]
+    if isinstance(value, (bytes, bytearray)):
+        return f"<{len(value)} bytes>"
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if not isinstance(value, str):
+        # 异常等其他对象按输出时的字符串形式脱敏，其消息中同样可能带有密钥或base64图片
+        value = str(value)
+    if value.startswith("data:") and ";base64," in value[:64]:
+        # 整个字段就是一张base64图片，无需逐字符扫描
+        return f"<base64 {len(value)}B>"
+    if "base64," in value:
+        value = _BASE64_PATTERN.sub(lambda m: f"<base64 {len(m.group())}B>", value)
+    if "sk-" in value:
+        value = _API_KEY_PATTERN.sub(lambda m: "sk-" + mask_secret(m.group()), value)
+    if max_length is not None and len(value) > max_length:
+        value = f"{value[:max_length]}...(共{len(value)}字)"
+    return value
+
+
+def _field_max_length(key, max_length):
+    return None if str(key).lower() in _UNTRUNCATED_FIELDS else max_length
+
+
+class StructuredLogger:
+    """结构化日志：事件名 + key=value 字段
+
+    字段只有在对应日志级别开启时才会格式化；可调用对象作为字段值时延迟求值。
+    所有字段自动脱敏、截断，并附带当前请求的关联ID。
+    """
+
+    def __init__(self, base_logger, prefix: str = "[QwenImage]"):
+        self._logger = base_logger
+        self.prefix = prefix
+        self._sample_counts = {}
+        self._sample_lock = threading.Lock()
+
+    def isEnabledFor(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def debug(self, event: str, **fields):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._emit(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields):
+        if self._logger.isEnabledFor(logging.INFO):
+            self._emit(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields):
+        if self._logger.isEnabledFor(logging.WARNING):
+            self._emit(logging.WARNING, event, fields)
+
+    def error(self, event: str, **fields):
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._emit(logging.ERROR, event, fields)
+
+    def sampled(self, level: int, key: str, every: int, event: str, **fields):
+        """高频事件采样：同一key每every次只输出一次（第1次、第every+1次……）"""
+        if not self._logger.isEnabledFor(level):
+            return
+        with self._sample_lock:
+            count = self._sample_counts.get(key, 0) + 1
+            self._sample_counts[key] = count
+        if (count - 1) % every == 0:
+            fields["occurrences"] = count
+            self._emit(level, event, fields)
+
+    def _emit(self, level: int, event: str, fields: dict):
+        request_id = _request_id.get()
+        parts = [f"{self.prefix}[{request_id}]" if request_id else self.prefix, event]
+        for key, value in fields.items():
+            if callable(value):
+                value = value()
+            parts.append(f"{key}={redact(value, _field_max_length(key, MAX_FIELD_LENGTH))}")
+        # stacklevel指向调用debug/info等方法的位置，日志中的文件名和行号保持准确
+        self._logger.log(level, " ".join(parts), stacklevel=3)
+
+
+slog = StructuredLogger(logger)
@@ -0,0 +1,111 @@
+"""测试公共设置：把插件目录作为包 qwen_image 导入，以便被测模块使用相对导入
+
+测试不依赖机器人框架，也不会调用真实API：HTTP请求使用 FakeHttp 模拟，时间使用 FakeClock 控制。
+"""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "qwen_image" not in sys.modules:
+    _spec = importlib.util.spec_from_file_location("qwen_image", os.path.join(PLUGIN_DIR, "__init__.py"),
+                                                   submodule_search_locations=[PLUGIN_DIR])
+    _package = importlib.util.module_from_spec(_spec)
+    sys.modules["qwen_image"] = _package
+    _spec.loader.exec_module(_package)
+
+
+class FakeClock:
+    """替换模块中的 time，monotonic() 只在 advance() 时前进"""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+class FakeResponse:
+    def __init__(self, data: dict = None, status_code: int = 200):
+        self.data = data or {}
+        self.status_code = status_code
+        self.text = str(self.data)
+
+    def json(self) -> dict:
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error", response=self)
+
+
+class FakeHttp:
+    """模拟引擎的 requests.Session：按 (方法, URL) 返回预设的响应，并记录所有请求"""
+
+    def __init__(self):
+        self.routes = {}
+        self.calls = []
+
+    def route(self, method: str, url: str, handler):
+        """handler为响应、异常或可调用对象 handler(**kwargs)"""
+        self.routes[(method, url)] = handler
+
+    def _dispatch(self, method: str, url: str, **kwargs):
+        self.calls.append((method, url, kwargs))
+        handler = self.routes.get((method, url))
+        if handler is None:
+            return FakeResponse({}, status_code=404)
+        if callable(handler) and not isinstance(handler, FakeResponse):
+            handler = handler(**kwargs)
+        if isinstance(handler, Exception):
+            raise handler
+        return handler
+
+    def get(self, url: str, **kwargs):
+        return self._dispatch("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self._dispatch("POST", url, **kwargs)
+
+
+BASE_URL = "https://dashscope.test/image-synthesis"
+TASK_URL = "https://dashscope.test/tasks"
+
+
+def make_conf(**overrides) -> dict:
+    conf = {
+        "api_key_1": "sk-test-key-0001",
+        "api_key_2": "sk-test-key-0002",
+        "job_deadline": 5,
+        "qwen_image": {"base_url": BASE_URL, "task_base_url": TASK_URL},
+        "usage": {"file": ""},
+    }
+    conf.update(overrides)
+    return conf
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def fake_http():
+    return FakeHttp()
+
+
+@pytest.fixture
+def engine(fake_http):
+    from qwen_image.engine import QwenImageEngine
+
+    engine = QwenImageEngine(make_conf())
+    engine.http = fake_http
+    yield engine
+    engine._executor.shutdown(wait=True)
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from qwen_image.admission import AdmissionGate, DrainingError
+
+
+def test_admit_counts_in_flight_jobs():
+    gate = AdmissionGate()
+    with gate.admit():
+        assert gate.in_flight == 1
+        with gate.admit():
+            assert gate.in_flight == 2
+    assert gate.in_flight == 0
+
+
+def test_in_flight_released_when_job_fails():
+    gate = AdmissionGate()
+    with pytest.raises(ValueError):
+        with gate.admit():
+            raise ValueError("boom")
+    assert gate.in_flight == 0
+
+
+def test_drain_rejects_new_jobs_until_resumed():
+    gate = AdmissionGate()
+    assert gate.drain(0) == 0
+    assert gate.draining
+    with pytest.raises(DrainingError):
+        with gate.admit():
+            pass
+    assert gate.in_flight == 0
+    gate.resume()
+    with gate.admit():
+        assert gate.in_flight == 1
+
+
+def test_drain_waits_for_in_flight_jobs():
+    gate = AdmissionGate()
+    admitted = threading.Event()
+    release = threading.Event()
+
+    def job():
+        with gate.admit():
+            admitted.set()
+            release.wait(5)
+
+    worker = threading.Thread(target=job)
+    worker.start()
+    admitted.wait(5)
+    threading.Timer(0.05, release.set).start()
+    started = time.monotonic()
+    assert gate.drain(5) == 0
+    assert time.monotonic() - started < 5
+    worker.join(5)
+
+
+def test_drain_returns_unfinished_jobs_after_grace_period():
+    gate = AdmissionGate()
+    admitted = threading.Event()
+    release = threading.Event()
+
+    def job():
+        with gate.admit():
+            admitted.set()
+            release.wait(5)
+
+    worker = threading.Thread(target=job)
+    worker.start()
+    admitted.wait(5)
+    try:
+        assert gate.drain(0.05) == 1
+        assert gate.draining
+    finally:
+        release.set()
+        worker.join(5)
+    assert gate.in_flight == 0
+
+
+def test_background_job_counted_while_draining():
+    gate = AdmissionGate()
+    with gate.admit():
+        gate.drain(0)
+        gate.begin(check_draining=False)
+        assert gate.in_flight == 2
+    with pytest.raises(DrainingError):
+        gate.begin()
+    assert gate.in_flight == 1
+    gate.finish()
+    assert gate.drain(0) == 0
@@ -0,0 +1,113 @@
+import pytest
+
+from qwen_image import circuit_breaker
+from qwen_image.circuit_breaker import BreakerRegistry, CircuitBreaker
+
+
+@pytest.fixture
+def breaker(clock, monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    return CircuitBreaker("key-1", window=60, min_calls=4, error_rate=0.5, slow_call_seconds=10, cooldown=30)
+
+
+def test_stays_closed_below_min_calls(breaker):
+    for _ in range(3):
+        breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_opens_when_error_rate_reached(breaker):
+    breaker.record(True)
+    breaker.record(True)
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_slow_calls_count_as_failures(breaker):
+    for _ in range(4):
+        breaker.record(True, latency=12)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_samples_outside_window_are_dropped(breaker, clock):
+    breaker.record(False)
+    breaker.record(False)
+    clock.advance(61)
+    breaker.record(False)
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.snapshot()["calls"] == 2
+
+
+def _trip(breaker):
+    for _ in range(4):
+        breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_after_cooldown_allows_single_probe(breaker, clock):
+    _trip(breaker)
+    clock.advance(29)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes(breaker, clock):
+    _trip(breaker)
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record(True, latency=1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.snapshot()["calls"] == 1
+
+
+def test_failed_probe_reopens(breaker, clock):
+    _trip(breaker)
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.advance(10)
+    assert not breaker.allow()
+
+
+def test_stuck_probe_is_replaced_after_cooldown(breaker, clock):
+    _trip(breaker)
+    clock.advance(30)
+    assert breaker.allow()
+    clock.advance(29)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert breaker.allow()
+
+
+def test_latency_percentile(breaker):
+    assert breaker.latency_percentile(95) is None
+    for latency in (1, 2, 3, 4, 5):
+        breaker.record(True, latency=latency)
+    assert breaker.latency_percentile(50) == 3
+    assert breaker.latency_percentile(95) == 5
+
+
+def test_registry_reuses_breakers_and_keeps_state_on_configure(clock, monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    registry = BreakerRegistry(min_calls=2, error_rate=0.5)
+    breaker = registry.get(1)
+    assert registry.get(1) is breaker
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    registry.configure(min_calls=10, cooldown=5)
+    assert breaker.min_calls == 10
+    assert breaker.cooldown == 5
+    assert breaker.error_rate == CircuitBreaker("").error_rate
+    assert breaker.state == CircuitBreaker.OPEN
+    assert registry.get(2).min_calls == 10
+    assert set(registry.snapshot()) == {1, 2}
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from qwen_image.cli import BatchRunner, Checkpoint
+
+from conftest import BASE_URL, TASK_URL, FakeResponse
+
+
+def test_checkpoint_last_record_wins_across_runs(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    checkpoint = Checkpoint(path)
+    checkpoint.write("job-1", status="submitted", task_id="task-1", account=2, model="qwen-image")
+    checkpoint.write("job-2", status="failed", error="boom")
+    checkpoint.write("job-1", status="done", file="job-1.png", task_id="task-1")
+
+    resumed = Checkpoint(path)
+    assert resumed.get("job-1")["status"] == "done"
+    assert resumed.get("job-2")["status"] == "failed"
+    assert resumed.get("job-3") is None
+
+
+def test_checkpoint_ignores_truncated_last_line(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    record = {"id": "job-1", "status": "submitted", "task_id": "task-1", "account": 1}
+    path.write_text(json.dumps(record) + "\n" + '{"id": "job-2", "sta', encoding="utf-8")
+
+    checkpoint = Checkpoint(str(path))
+    assert checkpoint.get("job-1")["task_id"] == "task-1"
+    assert checkpoint.get("job-2") is None
+
+
+@pytest.fixture
+def runner(engine, tmp_path):
+    engine.config = engine.config._replace(job_deadline=0.2)
+    return BatchRunner(engine, str(tmp_path), Checkpoint(str(tmp_path / "checkpoint.jsonl")))
+
+
+JOB = {"id": "job-1", "prompt": "一只猫"}
+
+
+def _submit_and_poll(fake_http, status, **output):
+    fake_http.route("POST", BASE_URL, FakeResponse({"output": {"task_id": "task-1"}}))
+    fake_http.route("GET", f"{TASK_URL}/task-1", FakeResponse({"output": {"task_status": status, **output}}))
+
+
+def test_failed_task_is_recorded_and_resubmitted_on_rerun(runner, fake_http):
+    _submit_and_poll(fake_http, "FAILED", error_code="DataInspectionFailed", error_message="内容审核未通过")
+
+    result = runner.run_job(JOB)
+    assert result["status"] == "failed"
+    assert result["error_code"] == "DataInspectionFailed"
+    assert Checkpoint(runner.checkpoint.path).get("job-1")["status"] == "failed"
+
+    fake_http.calls.clear()
+    runner.run_job(JOB)
+    assert [method for method, url, _ in fake_http.calls].count("POST") == 1
+
+
+@pytest.mark.parametrize("status", ["PENDING", "RUNNING"])
+def test_unfinished_task_keeps_submitted_record_and_resumes(runner, fake_http, status):
+    _submit_and_poll(fake_http, status)
+    fake_http.route("POST", f"{TASK_URL}/task-1/cancel", FakeResponse({}, status_code=400))
+
+    result = runner.run_job(JOB)
+    assert result["status"] == "timeout"
+    assert Checkpoint(runner.checkpoint.path).get("job-1")["status"] == "submitted"
+
+    fake_http.route("GET", f"{TASK_URL}/task-1", FakeResponse({"output": {"task_status": "SUCCEEDED", "results": [{"url": "https://img.test/1.png"}]}}))
+    fake_http.route("GET", "https://img.test/1.png", FakeResponse())
+    fake_http.calls.clear()
+    runner.download = lambda job_id, image_url: f"{job_id}.png"
+    assert runner.run_job(JOB)["status"] == "done"
+    assert not any(method == "POST" for method, _, _ in fake_http.calls)
+
+
+def test_timeout_without_task_status_is_recorded_as_failed(runner, fake_http):
+    fake_http.route("POST", BASE_URL, FakeResponse({"output": {"task_id": "task-1"}}))
+    fake_http.route("GET", f"{TASK_URL}/task-1", FakeResponse({}, status_code=502))
+    assert runner.run_job(JOB)["status"] == "failed"
+    assert runner.checkpoint.get("job-1")["status"] == "failed"
@@ -0,0 +1,80 @@
+"""参数解析与命令路由：新实现（PromptParser、前缀树）与原实现的解析结果必须完全一致"""
+import random
+
+import pytest
+
+from qwen_image.bench import CHAT_MESSAGES, COMMAND_MESSAGES, TEMPLATE_PATH, LegacyParser, legacy_route, trie_route
+from qwen_image.compiled_config import COMMANDS, compile_config
+from qwen_image.engine import load_config_file
+
+# 参数解析的一致性语料，包含参数重叠、拼接和非法比例等边界情况
+PARSER_CORPUS = [
+    "",
+    "一只可爱的小猫",
+    "一张酷炫的电影海报 --ar 3:4 --plus",
+    "快速生成的风景画 --ar 16:9 --flash",
+    "美丽的花朵 --负面提示：模糊，低质量",
+    "花 --负面提示：模糊 --ar 9:16 --plus",
+    "猫 --ar 7:3",
+    "猫 --ar １６:９",
+    "猫 --flash --plus",
+    "--plus--flash",
+    "--负面提示：--ar 1:1",
+    "--负面提示：",
+    "--负面提示： ",
+    "--fl--plusash 狗",
+    "--负--plus面提示：模糊",
+    "--ar 4:3--ar 1:1",
+    "中文标点！--负面提示：丑。好看",
+    "  多个   空格  ",
+    "猫\n--ar 1:1\t--flash",
+    "文本 -- 双横线 -",
+]
+
+_FUZZ_TOKENS = ["猫", "风景", " ", "  ", "\t", "-", "--", "--ar ", "--ar 16:9", "1:1", "3:4", "7:7", "--plus",
+                "--flash", "--fl", "ash", "pl", "us", "--负面提示：", "--负", "面提示：", "模糊", "，", "。", "！", "？"]
+
+FUZZ_CASES = 5000
+
+
+def _fuzz_corpus(seed: int = 0) -> list:
+    """随机拼接的参数组合，种子固定以便复现"""
+    rng = random.Random(seed)
+    return ["".join(rng.choice(_FUZZ_TOKENS) for _ in range(rng.randint(1, 12))) for _ in range(FUZZ_CASES)]
+
+
+@pytest.fixture(scope="module")
+def conf():
+    return load_config_file(TEMPLATE_PATH)
+
+
+@pytest.fixture(scope="module")
+def parsers(conf):
+    config = compile_config(conf)
+    qwen_config = conf["qwen_image"]
+    legacy = LegacyParser(qwen_config["ratios"], qwen_config["default_ratio"], qwen_config["model"], config.default_model,
+                          qwen_config["default_negative_prompt"])
+    return config.prompt_parser, legacy
+
+
+def _assert_same_parse(parser, legacy, content):
+    assert tuple(parser.parse(content)) == legacy.parse(content), content
+    assert parser.ratio(content) == legacy.extract_ratio_from_prompt(content), content
+
+
+@pytest.mark.parametrize("content", PARSER_CORPUS)
+def test_parse_matches_legacy(parsers, content):
+    _assert_same_parse(*parsers, content)
+
+
+def test_parse_matches_legacy_on_fuzz_corpus(parsers):
+    for content in _fuzz_corpus():
+        _assert_same_parse(*parsers, content)
+
+
+def test_route_matches_legacy(conf):
+    config = compile_config(conf)
+    prefix_lists = [(command, conf.get(key, default)) for command, key, default in COMMANDS]
+    commands = [command for command, _, _ in COMMANDS]
+    for content in CHAT_MESSAGES + COMMAND_MESSAGES + PARSER_CORPUS + _fuzz_corpus(seed=1):
+        assert trie_route(content, config.command_trie, commands) == legacy_route(content, prefix_lists), content
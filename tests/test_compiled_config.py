@@ -0,0 +1,86 @@
+import copy
+
+import pytest
+
+from qwen_image.bench import TEMPLATE_PATH
+from qwen_image.compiled_config import ConfigError, compile_config
+from qwen_image.engine import load_config_file
+
+
+@pytest.fixture(scope="module")
+def template():
+    return load_config_file(TEMPLATE_PATH)
+
+
+def _with(template, section, key, value):
+    conf = copy.deepcopy(template)
+    conf.setdefault(section, {})[key] = value
+    return conf
+
+
+def test_template_compiles_to_read_only_config(template):
+    config = compile_config(template)
+    assert config.default_model in config.models
+    assert config.hedge["percentile"] == 95
+    with pytest.raises(TypeError):
+        config.usage["daily_budget_per_key"] = 1
+    with pytest.raises(AttributeError):
+        config.job_deadline = 1
+
+
+@pytest.mark.parametrize("section, key, value", [
+    ("usage", "daily_budget_per_key", "5"),
+    ("usage", "daily_budget_per_session", -1),
+    ("usage", "retention_days", 0),
+    ("usage", "prices", {"qwen-image": "0.25"}),
+    ("usage", "key_budgets", {"3": 10}),
+    ("usage", "file", None),
+    ("hedge", "percentile", "95"),
+    ("hedge", "percentile", 0),
+    ("hedge", "enabled", "yes"),
+    ("hedge", "max_workers", 2.5),
+    ("circuit_breaker", "window", "x"),
+    ("circuit_breaker", "error_rate", 1.5),
+    ("circuit_breaker", "min_calls", True),
+    ("drain", "grace_period", -1),
+    ("drain", "on_sigterm", 1),
+])
+def test_invalid_section_values_name_the_key(template, section, key, value):
+    with pytest.raises(ConfigError, match=f"{section}.{key} "):
+        compile_config(_with(template, section, key, value))
+
+
+def test_unknown_section_keys_are_rejected(template):
+    with pytest.raises(ConfigError, match="usage.daily_budget_per_keys"):
+        compile_config(_with(template, "usage", "daily_budget_per_keys", 5))
+
+
+@pytest.mark.parametrize("section", ["circuit_breaker", "hedge", "usage", "drain"])
+def test_sections_must_be_objects(template, section):
+    conf = copy.deepcopy(template)
+    conf[section] = []
+    with pytest.raises(ConfigError, match=section):
+        compile_config(conf)
+
+
+@pytest.mark.parametrize("key, value", [
+    ("job_deadline", 0),
+    ("job_deadline", "180"),
+    ("progressive_preview", "false"),
+    ("api_key_1", 123),
+    ("admin_users", "admin"),
+    ("admin_command", ["Q重载配置"]),
+    ("image_command", []),
+])
+def test_invalid_top_level_values(template, key, value):
+    conf = copy.deepcopy(template)
+    conf[key] = value
+    with pytest.raises(ConfigError, match=key):
+        compile_config(conf)
+
+
+def test_default_ratio_must_exist(template):
+    conf = copy.deepcopy(template)
+    conf["qwen_image"]["default_ratio"] = "2:1"
+    with pytest.raises(ConfigError, match="default_ratio"):
+        compile_config(conf)
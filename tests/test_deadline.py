@@ -0,0 +1,67 @@
+import threading
+import time
+
+import pytest
+
+from qwen_image.deadline import Deadline, DeadlineExceeded, JobCancelled
+
+
+def test_check_passes_before_expiry():
+    deadline = Deadline(60)
+    deadline.check("task-1")
+    assert not deadline.expired()
+    assert 0 < deadline.remaining() <= 60
+
+
+def test_check_raises_after_expiry():
+    deadline = Deadline(0)
+    assert deadline.expired()
+    assert deadline.remaining() == 0
+    with pytest.raises(DeadlineExceeded) as excinfo:
+        deadline.check("task-1")
+    assert excinfo.value.task_id == "task-1"
+    assert not excinfo.value.cancelled
+    assert not isinstance(excinfo.value, JobCancelled)
+
+
+def test_cancel_expires_immediately():
+    deadline = Deadline(60)
+    deadline.cancel()
+    assert deadline.cancelled
+    assert deadline.expired()
+    assert deadline.remaining() == 0
+    with pytest.raises(JobCancelled):
+        deadline.check()
+
+
+def test_sleep_returns_when_cancelled():
+    deadline = Deadline(60)
+    threading.Timer(0.05, deadline.cancel).start()
+    started = time.monotonic()
+    deadline.sleep(30)
+    assert time.monotonic() - started < 5
+
+
+def test_sleep_never_exceeds_remaining_time():
+    deadline = Deadline(0.05)
+    started = time.monotonic()
+    deadline.sleep(30)
+    assert time.monotonic() - started < 5
+
+
+def test_request_timeout_is_capped_by_remaining_time():
+    assert Deadline(60).request_timeout(30) == 30
+    assert Deadline(10).request_timeout(30) <= 10
+    with pytest.raises(DeadlineExceeded):
+        Deadline(0).request_timeout(30)
+
+
+def test_cancel_records_whether_superseded():
+    deadline = Deadline(60)
+    deadline.cancel(superseded=False)
+    assert not deadline.superseded
+    with pytest.raises(JobCancelled):
+        deadline.check()
+    deadline = Deadline(60)
+    deadline.cancel()
+    assert deadline.superseded
@@ -0,0 +1,394 @@
+"""引擎的账号路由、对冲提交和轮询（模拟HTTP）"""
+import threading
+
+import pytest
+import requests
+
+from qwen_image.circuit_breaker import CircuitOpenError
+from qwen_image.deadline import Deadline, DeadlineExceeded, JobCancelled
+from qwen_image.engine import TaskFailedError
+from qwen_image.usage_meter import BudgetExceededError
+
+from conftest import BASE_URL, TASK_URL, FakeResponse
+
+
+def _submitted(task_id):
+    return FakeResponse({"output": {"task_id": task_id, "task_status": "PENDING"}})
+
+
+def _status(status, **output):
+    return FakeResponse({"output": {"task_status": status, **output}, "usage": {"image_count": 1}})
+
+
+def _succeeded(url="https://img.test/1.png"):
+    return _status("SUCCEEDED", results=[{"url": url}])
+
+
+def _auth(kwargs):
+    return kwargs["headers"]["Authorization"]
+
+
+def test_select_prefers_current_account(engine):
+    assert engine._select_api_key() == (1, "sk-test-key-0001")
+    engine.current_account = 2
+    assert engine._select_api_key() == (2, "sk-test-key-0002")
+
+
+def test_select_routes_around_open_breaker(engine):
+    breaker = engine.key_breakers.get(1)
+    for _ in range(breaker.min_calls):
+        breaker.record(False)
+    assert engine._select_api_key()[0] == 2
+    for _ in range(breaker.min_calls):
+        engine.key_breakers.get(2).record(False)
+    with pytest.raises(CircuitOpenError):
+        engine._select_api_key()
+
+
+def test_select_routes_around_exhausted_budget(engine):
+    engine.usage.set_limits(prices={"qwen-image": 1.0}, key_budgets={1: 1, 2: 3})
+    engine.usage.record(1, "qwen-image")
+    reservation = engine.usage.reserve(None, 1)
+    assert engine._select_api_key(reservation=reservation)[0] == 2
+    assert reservation.accounts == [2]
+    engine.usage.record(2, "qwen-image", images=3)
+    with pytest.raises(BudgetExceededError):
+        engine._select_api_key(reservation=engine.usage.reserve(None, 1))
+
+
+def test_select_releases_reservation_on_open_breaker(engine):
+    engine.usage.set_limits(prices={"qwen-image": 1.0}, daily_budget_per_key=5)
+    breaker = engine.key_breakers.get(1)
+    for _ in range(breaker.min_calls):
+        breaker.record(False)
+    reservation = engine.usage.reserve(None, 1)
+    assert engine._select_api_key(reservation=reservation)[0] == 2
+    assert engine.usage.reserved("key", "1") == 0
+    assert engine.usage.reserved("key", "2") == 1
+
+
+def test_balance_keys_prefers_least_busy_account(engine):
+    engine.balance_keys = True
+    engine._key_in_flight[1] = 3
+    assert engine._select_api_key()[0] == 2
+
+
+def test_generate_image_polls_with_submitting_key_and_meters_usage(engine, fake_http):
+    fake_http.route("POST", BASE_URL, _submitted("task-1"))
+    fake_http.route("GET", f"{TASK_URL}/task-1", _succeeded())
+    submitted = []
+
+    url = engine.generate_image("一只猫", "1328*1328", "qwen-image", True, "", session_id="alice",
+                                on_submitted=lambda task_id, account: submitted.append((task_id, account)))
+
+    assert url == "https://img.test/1.png"
+    assert submitted == [("task-1", 1)]
+    poll = [kwargs for method, url, kwargs in fake_http.calls if method == "GET"]
+    assert _auth(poll[0]) == "Bearer sk-test-key-0001"
+    assert engine.usage.usage("session", "alice")[0] == 1
+    assert engine.job_stats["succeeded"] == 1
+
+
+def test_hedge_loser_is_cancelled(engine, fake_http):
+    slow_primary = threading.Event()
+
+    def submit(**kwargs):
+        if _auth(kwargs).endswith("0001"):
+            slow_primary.wait(5)
+            return _submitted("task-primary")
+        return _submitted("task-hedge")
+
+    engine.config = engine.config._replace(hedge={"default_delay": 0.05})
+    fake_http.route("POST", BASE_URL, submit)
+    fake_http.route("POST", f"{TASK_URL}/task-primary/cancel", FakeResponse({}))
+
+    engine.usage.set_limits(prices={"qwen-image": 1.0}, daily_budget_per_key=5)
+    reservation = engine.usage.reserve(None, 1)
+    task_id, account, _ = engine._submit_task({"model": "qwen-image"}, Deadline(5), reservation)
+    assert (task_id, account) == ("task-hedge", 2)
+    # 落败账号的预占立即释放，胜出账号的预占保留到出图后结算
+    assert reservation.accounts == [2]
+    assert engine.usage.reserved("key", "1") == 0
+    slow_primary.set()
+    engine._executor.shutdown(wait=True)
+
+    cancels = [url for method, url, _ in fake_http.calls if url.endswith("/cancel")]
+    assert cancels == [f"{TASK_URL}/task-primary/cancel"]
+    assert engine.job_stats["hedged"] == 1
+    assert engine.job_stats["hedge_won"] == 1
+    assert engine.job_stats["hedge_cancelled"] == 1
+
+
+def test_failed_submit_is_recorded_on_breakers(engine, fake_http):
+    fake_http.route("POST", BASE_URL, FakeResponse({}, status_code=500))
+    with pytest.raises(Exception, match="API请求失败"):
+        engine.generate_image("一只猫", "1328*1328", "qwen-image", True, "")
+    assert engine.endpoint_breakers.get(BASE_URL).snapshot()["error_rate"] == 1.0
+    assert engine.key_breakers.get(1).snapshot()["error_rate"] == 1.0
+
+
+def test_poll_transport_errors_are_retried(engine, fake_http):
+    responses = [requests.exceptions.ConnectionError("reset"), _status("RUNNING"), _succeeded()]
+    fake_http.route("GET", f"{TASK_URL}/task-1", lambda **kwargs: responses.pop(0))
+    assert engine._poll_task_result("task-1", retry_interval=0, deadline=Deadline(5)) == "https://img.test/1.png"
+
+
+def test_expired_pending_task_is_cancelled(engine, fake_http):
+    fake_http.route("GET", f"{TASK_URL}/task-1", _status("PENDING"))
+    fake_http.route("POST", f"{TASK_URL}/task-1/cancel", FakeResponse({}))
+    with pytest.raises(DeadlineExceeded) as excinfo:
+        engine._poll_task_result("task-1", retry_interval=0.01, deadline=Deadline(0.05))
+    assert excinfo.value.cancelled
+    assert engine.job_stats["cancelled"] == 1
+
+
+def test_expired_running_task_is_left_running(engine, fake_http):
+    fake_http.route("GET", f"{TASK_URL}/task-1", _status("RUNNING"))
+    with pytest.raises(DeadlineExceeded) as excinfo:
+        engine._poll_task_result("task-1", retry_interval=0.01, deadline=Deadline(0.05))
+    assert not excinfo.value.cancelled
+    assert engine.job_stats["expired_running"] == 1
+    assert not any(url.endswith("/cancel") for _, url, _ in fake_http.calls)
+
+
+def test_superseded_running_task_is_not_counted_as_timeout(engine, fake_http):
+    fake_http.route("GET", f"{TASK_URL}/task-1", _status("RUNNING"))
+    deadline = Deadline(30)
+    threading.Timer(0.05, deadline.cancel).start()
+    with pytest.raises(JobCancelled):
+        engine._poll_task_result("task-1", retry_interval=0.01, deadline=deadline)
+    assert engine.job_stats["expired_running"] == 0
+    assert engine.job_stats["deadline_exceeded"] == 0
+
+
+def test_failed_task_is_terminal(engine, fake_http):
+    fake_http.route("GET", f"{TASK_URL}/task-1", _status("FAILED", error_code="DataInspectionFailed", error_message="内容审核未通过"))
+    with pytest.raises(TaskFailedError) as excinfo:
+        engine._poll_task_result("task-1", retry_interval=1, deadline=Deadline(30))
+    assert excinfo.value.error_code == "DataInspectionFailed"
+    assert len(fake_http.calls) == 1
+    assert engine.job_stats["deadline_exceeded"] == 0
+
+
+def test_concurrent_jobs_cannot_overshoot_budget(engine, fake_http):
+    """进行中的任务预占预算：两个账号各剩1张的预算时，第3个并发任务在提交前就被拒绝"""
+    engine.usage.set_limits(prices={"qwen-image": 1.0}, daily_budget_per_key=1)
+    engine.config = engine.config._replace(hedge={"enabled": False})
+    release = threading.Event()
+    submitted = iter(range(10))
+    fake_http.route("POST", BASE_URL, lambda **kwargs: _submitted(f"task-{next(submitted)}"))
+
+    def poll(**kwargs):
+        release.wait(5)
+        return _succeeded()
+
+    for index in range(2):
+        fake_http.route("GET", f"{TASK_URL}/task-{index}", poll)
+    results = []
+
+    def job():
+        try:
+            results.append(engine.generate_image("猫", "1328*1328", "qwen-image", True, "", deadline=Deadline(5)))
+        except BudgetExceededError as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=job) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    while sum(1 for method, _, _ in fake_http.calls if method == "GET") < 2:
+        threading.Event().wait(0.01)
+    with pytest.raises(BudgetExceededError):
+        engine.generate_image("猫", "1328*1328", "qwen-image", True, "")
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["https://img.test/1.png"] * 2
+    assert engine.usage.usage("key", "1") == [1, 1.0]
+    assert engine.usage.usage("key", "2") == [1, 1.0]
+    assert engine.usage.reserved("key", "1") == engine.usage.reserved("key", "2") == 0
+
+
+def test_session_reservation_released_when_job_fails(engine, fake_http):
+    engine.usage.set_limits(prices={"qwen-image": 1.0}, daily_budget_per_session=1)
+    fake_http.route("POST", BASE_URL, _submitted("task-1"))
+    fake_http.route("GET", f"{TASK_URL}/task-1", _status("FAILED", error_code="InternalError"))
+    with pytest.raises(TaskFailedError):
+        engine.generate_image("猫", "1328*1328", "qwen-image", True, "", session_id="alice")
+    assert engine.usage.reserved("session", "alice") == 0
+    assert engine.usage.reserved("key", "1") == 0
+    assert engine.usage.remaining_session_budget("alice") == 1
+
+
+def test_reload_applies_new_settings_and_keeps_state(engine):
+    from conftest import make_conf
+
+    engine.usage.record(1, "qwen-image")
+    breaker = engine.key_breakers.get(1)
+    conf = make_conf(api_key_1="", job_deadline=60, circuit_breaker={"min_calls": 2},
+                     usage={"file": "", "daily_budget_per_key": 3})
+    config = engine.reload_config(conf)
+
+    assert engine.config is config
+    assert engine.job_deadline == 60
+    assert engine.current_account == 2
+    assert engine.current_api_key == "sk-test-key-0002"
+    assert engine.key_breakers.get(1) is breaker and breaker.min_calls == 2
+    assert engine.usage.daily_budget_per_key == 3
+    assert engine.usage.usage("key", "1")[0] == 1
+
+
+@pytest.mark.parametrize("section", [
+    {"usage": {"file": "", "daily_budget_per_key": "5"}},
+    {"hedge": {"percentile": "95"}},
+    {"circuit_breaker": {"window": "x"}},
+    {"drain": {"grace_period": -1}},
+])
+def test_invalid_reload_keeps_previous_config(engine, fake_http, section):
+    from conftest import make_conf
+    from qwen_image.compiled_config import ConfigError
+
+    previous = engine.config
+    with pytest.raises(ConfigError):
+        engine.reload_config(make_conf(job_deadline=60, **section))
+    assert engine.config is previous
+    assert engine.usage.daily_budget_per_key == 0
+    assert engine.key_breakers.settings == engine._breaker_settings(previous)
+
+    fake_http.route("POST", BASE_URL, _submitted("task-1"))
+    fake_http.route("GET", f"{TASK_URL}/task-1", _succeeded())
+    assert engine.generate_image("猫", "1328*1328", "qwen-image", True, "") == "https://img.test/1.png"
+
+
+@pytest.fixture
+def unwritable_engine(fake_http):
+    from conftest import make_conf
+    from qwen_image.engine import QwenImageEngine
+
+    engine = QwenImageEngine(make_conf(usage={"file": "/nonexistent-dir/usage.json"}))
+    engine.http = fake_http
+    yield engine
+    engine._executor.shutdown(wait=True)
+
+
+def test_unwritable_usage_file_does_not_lose_finished_image(unwritable_engine, fake_http):
+    engine = unwritable_engine
+    fake_http.route("POST", BASE_URL, _submitted("task-1"))
+    fake_http.route("GET", f"{TASK_URL}/task-1", _succeeded())
+
+    assert engine.generate_image("猫", "1328*1328", "qwen-image", True, "", session_id="alice") == "https://img.test/1.png"
+    assert engine.job_stats["succeeded"] == 1
+    assert engine.job_stats["deadline_exceeded"] == 0
+    assert len([call for call in fake_http.calls if call[0] == "GET"]) == 1
+    # 用量仍在内存中统计，预占已结算
+    assert engine.usage.usage("session", "alice")[0] == 1
+    assert engine.usage.reserved("session", "alice") == 0
+
+
+def test_unwritable_usage_file_does_not_fail_paid_edit(unwritable_engine, fake_http):
+    engine = unwritable_engine
+    engine.config = engine.config._replace(edit_base_url="https://dashscope.test/edit")
+    fake_http.route("POST", "https://dashscope.test/edit", FakeResponse(
+        {"output": {"choices": [{"message": {"content": [{"image": "https://img.test/edited.png"}]}}]}, "usage": {"image_count": 1}}))
+    engine._process_image_to_base64 = lambda image_content: "data:image/jpeg;base64,AAAA"
+
+    assert engine.edit_image(b"image", "改成海滩", session_id="alice") == "https://img.test/edited.png"
+    assert engine.usage.usage("session", "alice")[0] == 1
+
+
+def test_metering_failure_still_delivers_and_releases_reservation(engine, fake_http, monkeypatch):
+    def broken_record(*args, **kwargs):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(engine.usage, "record", broken_record)
+    engine.usage.set_limits(prices={"qwen-image": 1.0}, daily_budget_per_session=5)
+    fake_http.route("POST", BASE_URL, _submitted("task-1"))
+    fake_http.route("GET", f"{TASK_URL}/task-1", _succeeded())
+
+    assert engine.generate_image("猫", "1328*1328", "qwen-image", True, "", session_id="alice") == "https://img.test/1.png"
+    assert engine.job_stats["succeeded"] == 1
+    assert engine.usage.reserved("session", "alice") == 0
+
+
+def _submit_by_model(task_ids):
+    """按请求中的模型返回不同的任务ID"""
+    return lambda json, **kwargs: _submitted(task_ids[json["model"]])
+
+
+def _wait_for_preview_thread(engine):
+    deadline = Deadline(5)
+    while engine.admission.in_flight and not deadline.expired():
+        deadline.sleep(0.01)
+    assert engine.admission.in_flight == 0
+
+
+def test_progressive_delivers_preview_before_final_image(engine, fake_http):
+    preview_delivered = threading.Event()
+    delivered = []
+    fake_http.route("POST", BASE_URL, _submit_by_model({"wan2.2-t2i-flash": "task-p", "qwen-image": "task-f"}))
+    fake_http.route("GET", f"{TASK_URL}/task-p", _succeeded("https://img.test/preview.png"))
+    fake_http.route("GET", f"{TASK_URL}/task-f",
+                    lambda **kwargs: preview_delivered.wait(5) and _succeeded("https://img.test/final.png"))
+
+    def on_preview(url):
+        delivered.append(url)
+        preview_delivered.set()
+
+    url = engine.generate_image_progressive("一只猫", "1328*1328", "qwen-image", True, "", on_preview, session_id="alice")
+    delivered.append(url)
+    _wait_for_preview_thread(engine)
+
+    assert delivered == ["https://img.test/preview.png", "https://img.test/final.png"]
+    assert engine.job_stats["previews"] == 1
+    assert engine.usage.usage("session", "alice")[0] == 2
+
+
+def test_progressive_stops_preview_when_final_image_wins(engine, fake_http):
+    preview_polled = threading.Event()
+    delivered = []
+    fake_http.route("POST", BASE_URL, _submit_by_model({"wan2.2-t2i-flash": "task-p", "qwen-image": "task-f"}))
+    fake_http.route("GET", f"{TASK_URL}/task-p", lambda **kwargs: preview_polled.set() or _status("PENDING"))
+    fake_http.route("POST", f"{TASK_URL}/task-p/cancel", FakeResponse({}))
+    fake_http.route("GET", f"{TASK_URL}/task-f",
+                    lambda **kwargs: preview_polled.wait(5) and _succeeded("https://img.test/final.png"))
+
+    url = engine.generate_image_progressive("一只猫", "1328*1328", "qwen-image", True, "", delivered.append)
+    _wait_for_preview_thread(engine)
+
+    assert url == "https://img.test/final.png"
+    assert delivered == []
+    assert ("POST", f"{TASK_URL}/task-p/cancel") in [(method, url) for method, url, _ in fake_http.calls]
+    assert engine.job_stats["previews_dropped"] == 1
+    assert engine.job_stats["superseded"] == 0
+    assert engine.job_stats["deadline_exceeded"] == 0
+    assert engine.job_stats["cancelled"] == 0
+
+
+def test_superseded_final_task_is_cancelled_and_preview_still_delivered(engine, fake_http):
+    final_polled = threading.Event()
+    deadline = Deadline(5)
+    delivered = []
+    fake_http.route("POST", BASE_URL, _submit_by_model({"wan2.2-t2i-flash": "task-p", "qwen-image": "task-f"}))
+    fake_http.route("GET", f"{TASK_URL}/task-p",
+                    lambda **kwargs: final_polled.wait(5) and _succeeded("https://img.test/preview.png"))
+    fake_http.route("GET", f"{TASK_URL}/task-f", lambda **kwargs: final_polled.set() or _status("PENDING"))
+    fake_http.route("POST", f"{TASK_URL}/task-f/cancel", FakeResponse({}))
+
+    def on_preview(url):
+        delivered.append(url)
+        # 预览交付后同一会话发起了新的命令
+        deadline.cancel()
+
+    with pytest.raises(JobCancelled) as excinfo:
+        engine.generate_image_progressive("一只猫", "1328*1328", "qwen-image", True, "", on_preview,
+                                          deadline=deadline, session_id="alice")
+    _wait_for_preview_thread(engine)
+
+    assert excinfo.value.cancelled
+    assert excinfo.value.status == "PENDING"
+    assert delivered == ["https://img.test/preview.png"]
+    assert ("POST", f"{TASK_URL}/task-f/cancel") in [(method, url) for method, url, _ in fake_http.calls]
+    assert engine.job_stats["superseded"] == 1
+    assert engine.job_stats["previews"] == 1
+    assert engine.job_stats["cancelled"] == 0
+    assert engine.usage.usage("session", "alice")[0] == 1
@@ -0,0 +1,60 @@
+import logging
+
+import requests
+
+from qwen_image.structured_log import StructuredLogger, redact, request_context
+
+API_KEY = "sk-0123456789abcdef"
+IMAGE = "data:image/jpeg;base64," + "A" * 5000
+
+
+def test_strings_are_masked_and_truncated():
+    assert redact(IMAGE) == f"<base64 {len(IMAGE)}B>"
+    assert redact(f"key {API_KEY}") == "key sk-****cdef"
+    assert redact("x" * 300, max_length=10) == "xxxxxxxxxx...(共300字)"
+
+
+def test_secret_fields_in_dicts_are_masked():
+    payload = {"api_key": API_KEY, "input": {"messages": [{"image": IMAGE}, {"text": "猫"}]}}
+    assert redact(payload) == {"api_key": "****cdef", "input": {"messages": [{"image": f"<base64 {len(IMAGE)}B>"}, {"text": "猫"}]}}
+
+
+def test_scalars_are_kept():
+    assert redact(3) == 3
+    assert redact(1.5) == 1.5
+    assert redact(True) is True
+    assert redact(None) is None
+
+
+def test_exceptions_are_redacted():
+    error = requests.exceptions.HTTPError(f"401 for Bearer {API_KEY}, body {IMAGE}")
+    redacted = redact(error)
+    assert API_KEY not in redacted
+    assert "AAAA" not in redacted
+    assert len(redacted) < 200
+
+    assert len(redact(ValueError("x" * 5000))) < 250
+
+
+def test_structured_log_formats_redacted_fields(caplog):
+    base_logger = logging.getLogger("qwen_image.test")
+    slog = StructuredLogger(base_logger)
+    with caplog.at_level(logging.INFO, logger="qwen_image.test"), request_context("req-1"):
+        slog.info("请求失败", error=RuntimeError(f"bad key {API_KEY}"), status=401, url=lambda: "https://example.test")
+        slog.debug("不会输出", payload=lambda: 1 / 0)
+    assert caplog.messages == ["[QwenImage][req-1] 请求失败 error=bad key sk-****cdef status=401 url=https://example.test"]
+
+
+def test_url_fields_are_not_truncated(caplog):
+    url = "https://dashscope-result.oss-cn-beijing.aliyuncs.com/1d/ab/image.png?Expires=1760000000&OSSAccessKeyId=LTAI" + "x" * 300
+    assert redact({"results": [{"url": url}]}) == {"results": [{"url": url}]}
+
+    base_logger = logging.getLogger("qwen_image.test")
+    slog = StructuredLogger(base_logger)
+    with caplog.at_level(logging.INFO, logger="qwen_image.test"):
+        slog.info("图片生成成功，已交付", url=url, prompt="x" * 300)
+        slog.info("🖼️ 获取到编辑结果", url=f"key {API_KEY} {IMAGE}")
+    assert f"url={url} " in caplog.messages[0]
+    assert "prompt=" + "x" * 200 + "...(共300字)" in caplog.messages[0]
+    # url字段同样折叠base64图片、对密钥打码
+    assert caplog.messages[1].endswith(f"url=key sk-****cdef <base64 {len(IMAGE)}B>")
@@ -0,0 +1,149 @@
+import json
+import threading
+
+import pytest
+
+from qwen_image.usage_meter import BudgetExceededError, DEFAULT_PRICES, UsageMeter
+
+
+def test_record_accumulates_per_dimension():
+    meter = UsageMeter()
+    meter.record(1, "qwen-image", "alice")
+    meter.record(1, "wan2.2-t2i-flash", "alice")
+    meter.record(2, "qwen-image", None, images=2)
+
+    snapshot = meter.snapshot()
+    assert snapshot["key"]["1"] == [2, DEFAULT_PRICES["qwen-image"] + DEFAULT_PRICES["wan2.2-t2i-flash"]]
+    assert snapshot["key"]["2"] == [2, 2 * DEFAULT_PRICES["qwen-image"]]
+    assert snapshot["model"]["qwen-image"][0] == 3
+    assert snapshot["session"] == {"alice": [2, pytest.approx(0.39)]}
+
+
+def test_unknown_model_uses_default_price():
+    meter = UsageMeter(prices={"qwen-image": 1.0})
+    assert meter.estimate("some-new-model", images=2) == 2.0
+
+
+def test_zero_budget_means_unlimited():
+    meter = UsageMeter()
+    meter.record(1, "qwen-image", "alice", images=100)
+    assert meter.remaining_key_budget(1) is None
+    assert meter.has_key_budget(1, 1000)
+    meter.check_session_budget("alice", 1000)
+
+
+def test_key_budget_and_per_key_override():
+    meter = UsageMeter(prices={"qwen-image": 1.0}, daily_budget_per_key=2, key_budgets={2: 5})
+    meter.record(1, "qwen-image")
+    assert meter.has_key_budget(1, 1)
+    meter.record(1, "qwen-image")
+    assert not meter.has_key_budget(1, 1)
+    assert meter.remaining_key_budget(2) == 5
+
+
+def test_session_budget():
+    meter = UsageMeter(prices={"qwen-image": 1.0}, daily_budget_per_session=1.5)
+    meter.check_session_budget("alice", 1)
+    meter.record(1, "qwen-image", "alice")
+    with pytest.raises(BudgetExceededError):
+        meter.check_session_budget("alice", 1)
+    meter.check_session_budget("bob", 1)
+    meter.check_session_budget(None, 1)
+
+
+def test_usage_persists_across_restarts(tmp_path):
+    path = str(tmp_path / "usage.json")
+    UsageMeter(path=path).record(1, "qwen-image", "alice")
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f)
+    assert UsageMeter(path=path).usage("session", "alice")[0] == 1
+
+
+def test_corrupt_store_starts_fresh(tmp_path):
+    path = tmp_path / "usage.json"
+    path.write_text("{not json", encoding="utf-8")
+    meter = UsageMeter(path=str(path))
+    meter.record(1, "qwen-image")
+    assert meter.usage("key", "1")[0] == 1
+
+
+def test_old_days_are_trimmed(monkeypatch):
+    meter = UsageMeter(retention_days=2)
+    for day in ("2026-01-01", "2026-01-02", "2026-01-03"):
+        monkeypatch.setattr(meter, "_today", lambda day=day: day)
+        meter.record(1, "qwen-image")
+    assert sorted(meter._days) == ["2026-01-02", "2026-01-03"]
+
+
+def test_configure_keeps_recorded_usage():
+    meter = UsageMeter()
+    meter.record(1, "qwen-image")
+    meter.configure({"daily_budget_per_key": 0.3, "prices": {"qwen-image": 0.1}})
+    assert meter.remaining_key_budget(1) == pytest.approx(0.3 - DEFAULT_PRICES["qwen-image"])
+    assert meter.estimate("qwen-image") == 0.1
+
+
+def test_processes_sharing_a_file_merge_usage(tmp_path):
+    path = str(tmp_path / "usage.json")
+    plugin = UsageMeter(path=path, prices={"qwen-image": 1.0}, daily_budget_per_key=3)
+    cli = UsageMeter(path=path, prices={"qwen-image": 1.0}, daily_budget_per_key=3)
+
+    plugin.record(1, "qwen-image", "alice")
+    cli.record(1, "qwen-image", "cli")
+    plugin.record(1, "qwen-image", "alice")
+
+    # 双方都能看到对方的用量，写回时也不会覆盖对方的记录
+    assert cli.usage("key", "1") == [3, 3.0]
+    assert not cli.has_key_budget(1, 1)
+    assert UsageMeter(path=path).snapshot()["session"] == {"alice": [2, 2.0], "cli": [1, 1.0]}
+
+
+def test_concurrent_writers_do_not_lose_usage(tmp_path):
+    path = str(tmp_path / "usage.json")
+    meters = [UsageMeter(path=path) for _ in range(2)]
+
+    def record(meter):
+        for _ in range(50):
+            meter.record(1, "qwen-image")
+
+    threads = [threading.Thread(target=record, args=(meter,)) for meter in meters]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert UsageMeter(path=path).usage("key", "1")[0] == 100
+
+
+def test_reservations_count_against_budget_until_settled():
+    meter = UsageMeter(prices={"qwen-image": 1.0}, daily_budget_per_key=2, daily_budget_per_session=2)
+    first = meter.reserve("alice", 1)
+    assert first.reserve_key(1)
+    second = meter.reserve("alice", 1)
+    assert second.reserve_key(1)
+    with pytest.raises(BudgetExceededError):
+        meter.reserve("alice", 1)
+    assert not meter.reserve("bob", 1).reserve_key(1)
+    assert meter.remaining_key_budget(1) == 0
+
+    # 结算：预占转为实际用量，不会重复计算
+    meter.record(1, "qwen-image", "alice", reservation=first)
+    assert first.accounts == [] and not first.session_held
+    assert meter.remaining_key_budget(1) == 0
+    assert meter.reserved("key", "1") == 1
+
+    # 释放：失败或取消的任务归还预占
+    second.release()
+    second.release()
+    assert meter.remaining_key_budget(1) == 1
+    assert meter.remaining_session_budget("alice") == 1
+    assert meter.reserved("session", "alice") == 0
+
+
+def test_release_key_only_releases_that_account():
+    meter = UsageMeter(prices={"qwen-image": 1.0}, daily_budget_per_key=1)
+    reservation = meter.reserve(None, 1)
+    assert reservation.reserve_key(1)
+    assert reservation.reserve_key(2)
+    reservation.release_key(1)
+    assert meter.remaining_key_budget(1) == 1
+    assert meter.remaining_key_budget(2) == 0
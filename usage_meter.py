@@ -0,0 +1,304 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows没有fcntl，使用msvcrt的字节锁
+    fcntl = None
+    import msvcrt
+
+from .structured_log import logger, slog
+
+# 各模型每张图片的参考单价（元），可在配置 usage.prices 中覆盖
+DEFAULT_PRICES = {
+    "qwen-image": 0.25,
+    "qwen-image-edit": 0.3,
+    "wan2.2-t2i-flash": 0.14,
+    "wan2.2-t2i-plus": 0.2,
+}
+
+
+class BudgetExceededError(Exception):
+    """今日预算已用完"""
+
+
+class Reservation:
+    """一个任务预占的预算：受理时预占会话额度，选定账号时预占账号预算，
+    出图后随记账一起结算，失败或取消时释放
+
+    预占的费用在剩余预算中扣除，并发的任务（批量CLI并发、渐进模式的预览和最终图片、对冲提交）
+    不会同时通过预算检查而超出额度。
+    """
+
+    def __init__(self, meter: "UsageMeter", session_id: str, cost: float):
+        self.meter = meter
+        self.session_id = session_id
+        self.cost = cost
+        self.accounts = []  # 已预占预算的账号
+        self.session_held = False
+
+    def reserve_key(self, account) -> bool:
+        """账号剩余预算足够时预占本次费用，返回是否成功"""
+        if not self.meter._reserve("key", str(account), self.meter.key_budget(account), self.cost):
+            return False
+        self.accounts.append(account)
+        return True
+
+    def release_key(self, account):
+        """释放某个账号的预占（如对冲落败的账号）"""
+        if account in self.accounts:
+            self.accounts.remove(account)
+            self.meter._release("key", str(account), self.cost)
+
+    def release(self):
+        """释放尚未结算的全部预占；已结算或已释放时不做任何事"""
+        for account in list(self.accounts):
+            self.release_key(account)
+        if self.session_held:
+            self.session_held = False
+            self.meter._release("session", self.session_id, self.cost)
+
+
+class UsageMeter:
+    """按账号、模型、会话统计每日出图数量和估算费用，并检查每日预算
+
+    数据按天分桶，每个维度只记录 [图片数, 费用] 两个数字，只保留最近 retention_days 天，
+    每次记账后写回JSON文件，重启后继续累计。预算为0表示不限制。
+
+    多个进程（插件和批量CLI）可以共用同一个用量文件：记账时在文件锁内重新读取文件、累加后写回，
+    查询时文件被其他进程更新过则重新读取，各进程都能看到彼此的用量。
+    """
+
+    def __init__(self, path: str = None, prices: dict = None, daily_budget_per_key: float = 0, key_budgets: dict = None,
+                 daily_budget_per_session: float = 0, retention_days: int = 7):
+        self.path = path
+        self.set_limits(prices, daily_budget_per_key, key_budgets, daily_budget_per_session, retention_days)
+        self._days = {}  # 日期 -> {"key": {账号: [图片数, 费用]}, "model": {...}, "session": {...}}
+        self._file_stamp = None  # 最近一次读取或写入的用量文件 (修改时间, 大小)
+        self._reserved = {"key": {}, "session": {}}  # 进行中任务预占的费用（只在本进程内）
+        self._lock = threading.Lock()
+        with self._lock:
+            self._refresh()
+
+    @classmethod
+    def from_config(cls, usage_config: dict, default_dir: str) -> "UsageMeter":
+        path = usage_config.get("file", "usage.json")
+        if path and not os.path.isabs(path):
+            path = os.path.join(default_dir, path)
+        meter = cls(path=path)
+        meter.configure(usage_config)
+        return meter
+
+    def set_limits(self, prices: dict = None, daily_budget_per_key: float = 0, key_budgets: dict = None,
+                   daily_budget_per_session: float = 0, retention_days: int = 7):
+        """设置单价、预算和保留天数；重新加载配置时调用，已累计的用量不变"""
+        self.prices = dict(DEFAULT_PRICES, **(prices or {}))
+        self.daily_budget_per_key = daily_budget_per_key
+        self.key_budgets = {str(account): budget for account, budget in (key_budgets or {}).items()}
+        self.daily_budget_per_session = daily_budget_per_session
+        self.retention_days = retention_days
+
+    @staticmethod
+    def limits_from_config(usage_config: dict) -> dict:
+        """配置中的usage段 -> set_limits的参数"""
+        return {
+            "prices": usage_config.get("prices"),
+            "daily_budget_per_key": usage_config.get("daily_budget_per_key", 0),
+            "key_budgets": usage_config.get("key_budgets"),
+            "daily_budget_per_session": usage_config.get("daily_budget_per_session", 0),
+            "retention_days": usage_config.get("retention_days", 7),
+        }
+
+    def configure(self, usage_config: dict):
+        """按配置中的usage段更新单价和预算（用量文件路径不变）"""
+        self.set_limits(**self.limits_from_config(usage_config))
+
+    def estimate(self, model: str, images: int = 1) -> float:
+        """估算费用，未知模型按 qwen-image 的单价计算"""
+        return images * self.prices.get(model, self.prices["qwen-image"])
+
+    def reserve(self, session_id: str, cost: float) -> Reservation:
+        """受理任务时预占会话额度，额度不足时抛出BudgetExceededError；账号预算在选定账号时预占"""
+        reservation = Reservation(self, session_id, cost)
+        if session_id is not None:
+            if not self._reserve("session", session_id, self.daily_budget_per_session, cost):
+                raise BudgetExceededError(f"今日额度已用完（每日 ¥{self.daily_budget_per_session:.2f}），请明天再试")
+            reservation.session_held = True
+        return reservation
+
+    def record(self, account, model: str, session_id: str = None, images: int = 1, reservation: Reservation = None) -> float:
+        """记录一次成功出图，返回估算费用；传入reservation时同时结算该任务的预占"""
+        cost = self.estimate(model, images)
+        day = self._today()
+        with self._lock, self._file_lock():
+            # 在文件锁内重新读取，合并其他进程写入的用量后再累加，避免覆盖
+            self._refresh(force=True)
+            bucket = self._days.setdefault(day, {"key": {}, "model": {}, "session": {}})
+            for dimension, name in (("key", str(account)), ("model", model), ("session", session_id)):
+                if name is None:
+                    continue
+                entry = bucket[dimension].setdefault(name, [0, 0.0])
+                entry[0] += images
+                entry[1] = round(entry[1] + cost, 4)
+            for old_day in sorted(self._days)[:-self.retention_days]:
+                del self._days[old_day]
+            self._save()
+            if reservation is not None:
+                # 与记账在同一把锁内结算，预占和实际用量不会被重复计算
+                for reserved_account in reservation.accounts:
+                    self._release_locked("key", str(reserved_account), reservation.cost)
+                if reservation.session_held:
+                    self._release_locked("session", reservation.session_id, reservation.cost)
+                reservation.accounts = []
+                reservation.session_held = False
+        slog.info("记录用量", account=account, model=model, session=session_id, images=images, cost=f"{cost:.2f}")
+        return cost
+
+    def key_budget(self, account) -> float:
+        return self.key_budgets.get(str(account), self.daily_budget_per_key)
+
+    def remaining_key_budget(self, account):
+        """账号今日剩余预算（已扣除进行中任务的预占），不限制时返回None"""
+        with self._lock:
+            return self._remaining_locked("key", str(account), self.key_budget(account))
+
+    def remaining_session_budget(self, session_id: str):
+        """会话今日剩余额度（已扣除进行中任务的预占），不限制时返回None"""
+        if session_id is None:
+            return None
+        with self._lock:
+            return self._remaining_locked("session", session_id, self.daily_budget_per_session)
+
+    def has_key_budget(self, account, cost: float) -> bool:
+        remaining = self.remaining_key_budget(account)
+        return remaining is None or remaining >= cost
+
+    def check_session_budget(self, session_id: str, cost: float):
+        """会话今日预算不足时抛出BudgetExceededError"""
+        remaining = self.remaining_session_budget(session_id)
+        if remaining is not None and remaining < cost:
+            raise BudgetExceededError(f"今日额度已用完（每日 ¥{self.daily_budget_per_session:.2f}），请明天再试")
+
+    def usage(self, dimension: str, name: str) -> list:
+        """今日某个维度的 [图片数, 费用]"""
+        with self._lock:
+            self._refresh()
+            return list(self._days.get(self._today(), {}).get(dimension, {}).get(name, [0, 0.0]))
+
+    def snapshot(self) -> dict:
+        """今日各维度用量的副本"""
+        with self._lock:
+            self._refresh()
+            bucket = self._days.get(self._today(), {})
+            return {dimension: {name: list(entry) for name, entry in bucket.get(dimension, {}).items()}
+                    for dimension in ("key", "model", "session")}
+
+    def reserved(self, dimension: str, name: str) -> float:
+        """进行中任务预占的费用"""
+        with self._lock:
+            return self._reserved[dimension].get(name, 0.0)
+
+    def _today(self) -> str:
+        return time.strftime("%Y-%m-%d")
+
+    def _remaining_locked(self, dimension: str, name: str, budget: float):
+        if not budget:
+            return None
+        self._refresh()
+        spent = self._days.get(self._today(), {}).get(dimension, {}).get(name, [0, 0.0])[1]
+        return budget - spent - self._reserved[dimension].get(name, 0.0)
+
+    def _reserve(self, dimension: str, name: str, budget: float, cost: float) -> bool:
+        """剩余预算足够时预占cost（检查和预占在同一把锁内完成），不限制预算时同样记录预占"""
+        with self._lock:
+            remaining = self._remaining_locked(dimension, name, budget)
+            if remaining is not None and remaining < cost:
+                return False
+            reserved = self._reserved[dimension]
+            reserved[name] = reserved.get(name, 0.0) + cost
+            return True
+
+    def _release(self, dimension: str, name: str, cost: float):
+        with self._lock:
+            self._release_locked(dimension, name, cost)
+
+    def _release_locked(self, dimension: str, name: str, cost: float):
+        reserved = self._reserved[dimension]
+        left = round(reserved.get(name, 0.0) - cost, 4)
+        if left > 0:
+            reserved[name] = left
+        else:
+            reserved.pop(name, None)
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self, force: bool = False):
+        """用量文件被（其他进程）更新过时重新读取；调用方需持有self._lock"""
+        if not self.path:
+            return
+        stamp = self._stat()
+        if stamp is None or (stamp == self._file_stamp and not force):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._days = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"[QwenImage] 读取用量记录失败，继续使用内存中的统计: {e}")
+        self._file_stamp = stamp
+
+    @contextmanager
+    def _file_lock(self):
+        """跨进程的用量文件锁，保证读取-累加-写回不会被其他进程打断
+
+        锁文件无法创建或加锁（目录只读、不存在等）时不加锁继续，只记录警告，记账不影响出图。
+        """
+        if not self.path:
+            yield
+            return
+        try:
+            lock_file = open(f"{self.path}.lock", "a+")
+        except OSError as e:
+            logger.warning(f"[QwenImage] 无法打开用量文件锁，本次不加锁记账: {e}")
+            yield
+            return
+        with lock_file:
+            try:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            except OSError as e:
+                logger.warning(f"[QwenImage] 用量文件加锁失败，本次不加锁记账: {e}")
+                yield
+                return
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _save(self):
+        """写回用量文件，调用方需持有self._lock和文件锁"""
+        if not self.path:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._days, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+            self._file_stamp = self._stat()
+        except OSError as e:
+            logger.warning(f"[QwenImage] 保存用量记录失败: {e}")